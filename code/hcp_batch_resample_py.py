@@ -4,12 +4,20 @@ HCP静息态数据批量重采样到fsaverage4 - Python版本
 """
 
 import os
+import re
 import sys
+import csv
+import shlex
+import select
+import shutil
+import signal
 import subprocess
+import tempfile
+import time
 import logging
+import logging.handlers
 from pathlib import Path
 from datetime import datetime
-from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 import multiprocessing
 
@@ -19,8 +27,46 @@ CONFIG = {
     'OUTPUT_DIR': '/media/yxl/yxl_4TB/hcp_resample/all_subject',
     'ATLAS_PATH': '/media/yxl/yxl_4TB/hcp_resample/standard_mesh_atlases', 
     'PARALLEL_JOBS': multiprocessing.cpu_count() // 2,  # 使用一半的CPU核心
+    'TEMP_DIR': os.environ.get('HCP_TMP', '/dev/shm'),  # 中间GIFTI放在内存文件系统
+    'ENGINE': 'wb_command',
+    'IO_PROBE': False,  # 按输入盘读带宽限制并行任务数
+    'SUBJECT_SCRIPT': False,  # 同一被试的所有run合并为一个bash脚本
+    'PERSISTENT_SHELL': False,  # 每个工作进程用一个常驻bash执行wb_command
+    'PER_FILE_TIMEOUT': 600,  # 单个文件所有wb_command调用的总超时（秒），0表示不限制
 }
 
+# 临时目录剩余空间低于该值时回退到输出目录（每个半球约150 MB）
+TEMP_MIN_FREE_BYTES = 500 * 1024 * 1024
+
+# REST数据文件名模式
+REST_PREFIX = 'rfMRI_REST'
+REST_SUFFIX = '_Atlas_hp2000_clean.dtseries.nii'
+REST_PATTERN = f'{REST_PREFIX}*{REST_SUFFIX}'
+
+# HCP被试ID为6位数字，其他目录（logs等）不进入扫描
+SUBJECT_RE = re.compile(r'\d{6}')
+
+# 读带宽探测：读取量、每个工作进程大约需要的带宽、视为高速盘（NVMe）的阈值
+IO_PROBE_BYTES = 100 * 1024 * 1024
+IO_MBPS_PER_WORKER = 80
+IO_FAST_DISK_MBPS = 1000
+
+# 所有被试共用的逐文件处理记录（由驱动进程统一写入）
+FILE_LOG_NAME = 'processing_summary.csv'
+FILE_LOG_FIELDS = ['time', 'subject', 'filename', 'success', 'message']
+
+# 重采样引擎：wb_command（每个文件调用三次wb_command）或python（nibabel+预计算稀疏权重）
+ENGINES = ['wb_command', 'python']
+
+# 内置引擎使用的CIFTI结构名
+CIFTI_STRUCTURES = {
+    'L': 'CIFTI_STRUCTURE_CORTEX_LEFT',
+    'R': 'CIFTI_STRUCTURE_CORTEX_RIGHT',
+}
+
+# 探测重采样权重时每次wb_command调用的单位向量列数
+WEIGHT_PROBE_COLUMNS = 2048
+
 # 球面和面积文件路径
 SPHERE_FILES = {
     'fs_LR_32k_L': 'resample_fsaverage/fs_LR-deformed_to-fsaverage.L.sphere.32k_fs_LR.surf.gii',
@@ -36,6 +82,606 @@ AREA_FILES = {
     'fsavg4_R': 'resample_fsaverage/fsaverage4.R.midthickness_va_avg.3k_fsavg_R.shape.gii',
 }
 
+# 常驻bash每执行完一段命令输出的哨兵行前缀（后接退出码）
+SHELL_SENTINEL = '__HCP_DONE__'
+
+# 工作进程内的全局配置，由init_worker在每个进程启动时设置一次
+_WORKER_CONFIG = {}
+
+
+def init_worker(wb_command, sphere_paths, area_paths, temp_root=None, weight_specs=None,
+                subject_script=False, timeout=None, log_queue=None, persistent_shell=False):
+    """进程池initializer：只传一次纯字符串路径，任务本身只携带文件路径
+    
+    wb_command为驱动进程解析出的绝对路径，避免每次启动子进程都搜索PATH。
+    给出weight_specs时使用内置引擎，重采样权重从驱动进程的共享内存挂载。
+    给出log_queue时，工作进程的日志只发往该队列，由驱动进程的QueueListener统一写出。
+    """
+    if log_queue is not None:
+        # fork继承来的FileHandler/StreamHandler换成单个QueueHandler，避免多进程同时写日志文件
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        
+    _WORKER_CONFIG['wb_command'] = wb_command
+    _WORKER_CONFIG['sphere_paths'] = dict(sphere_paths)
+    _WORKER_CONFIG['area_paths'] = dict(area_paths)
+    _WORKER_CONFIG['temp_root'] = temp_root
+    _WORKER_CONFIG['subject_script'] = subject_script
+    _WORKER_CONFIG['timeout'] = timeout
+    _WORKER_CONFIG['persistent_shell'] = persistent_shell
+    _WORKER_CONFIG['shell'] = None
+    _WORKER_CONFIG['weights'] = None
+    _WORKER_CONFIG['shared_blocks'] = []
+    
+    # 球面/面积文件被每次重采样重复读取，提前读入页缓存
+    for path in [*sphere_paths.values(), *area_paths.values()]:
+        fadvise_file(path, 'POSIX_FADV_WILLNEED')
+        
+    if weight_specs:
+        _WORKER_CONFIG['weights'] = {}
+        for hemi, spec in weight_specs.items():
+            blocks, _WORKER_CONFIG['weights'][hemi] = attach_sparse_matrix(spec)
+            # 共享内存块需在进程生命周期内保持引用
+            _WORKER_CONFIG['shared_blocks'].extend(blocks)
+
+
+def fadvise_file(path, advice):
+    """对整个文件调用posix_fadvise（advice为os模块中的常量名），平台不支持或出错时忽略
+    
+    WILLNEED/DONTNEED作用于全局页缓存，因此在本进程内打开文件给出建议即可
+    影响随后wb_command对同一文件的读取。
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def share_sparse_matrix(matrix):
+    """把CSR矩阵的data/indices/indptr复制到共享内存
+    
+    返回 (共享内存块列表, 可pickle的描述信息)，块由调用方负责close/unlink。
+    """
+    import numpy as np
+    from multiprocessing import shared_memory
+    
+    blocks = []
+    spec = {'shape': matrix.shape, 'arrays': {}}
+    for field in ['data', 'indices', 'indptr']:
+        array = getattr(matrix, field)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        spec['arrays'][field] = (block.name, array.shape, array.dtype.str)
+    return blocks, spec
+
+
+def attach_sparse_matrix(spec):
+    """按share_sparse_matrix的描述信息挂载共享内存，零拷贝重建CSR矩阵"""
+    import numpy as np
+    from multiprocessing import shared_memory
+    from scipy import sparse
+    
+    blocks = []
+    arrays = {}
+    for field, (name, shape, dtype) in spec['arrays'].items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        arrays[field] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        
+    matrix = sparse.csr_matrix(
+        (arrays['data'], arrays['indices'], arrays['indptr']),
+        shape=spec['shape'], copy=False
+    )
+    return blocks, matrix
+
+
+def file_deadline():
+    """按PER_FILE_TIMEOUT计算当前文件的截止时间（time.monotonic），不限制时返回None"""
+    timeout = _WORKER_CONFIG.get('timeout')
+    return time.monotonic() + timeout if timeout else None
+
+
+def run_commands_concurrently(commands, deadline=None):
+    """同时启动多条互不依赖的命令并等待全部结束，任一失败则抛出CalledProcessError
+    
+    wb_command的进度输出直接丢弃，只保留stderr用于报错。
+    超过deadline（time.monotonic）时杀死所有命令并回收，然后抛出TimeoutExpired。
+    """
+    processes = [
+        subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, bufsize=65536)
+        for cmd in commands
+    ]
+    
+    error = None
+    for cmd, process in zip(commands, processes):
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        try:
+            _, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            # 杀死并回收全部子进程，避免留下僵尸进程和卡住的wb_command
+            for other in processes:
+                other.kill()
+            for other in processes:
+                other.communicate()
+            raise
+        if process.returncode != 0 and error is None:
+            error = subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr)
+            
+    if error is not None:
+        raise error
+
+
+def start_worker_shell():
+    """启动工作进程常驻的bash，命令从stdin读入，stdout只输出哨兵行
+    
+    bash在单独的会话中运行，超时时可连同正在执行的wb_command一起杀死；
+    工作进程退出时stdin关闭，bash随之退出。
+    """
+    process = subprocess.Popen(
+        ['bash'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        text=True, bufsize=1, start_new_session=True
+    )
+    _WORKER_CONFIG['shell'] = process
+    return process
+
+
+def stop_worker_shell():
+    """杀死常驻bash所在的进程组并回收，下次使用时重新启动"""
+    process = _WORKER_CONFIG.get('shell')
+    _WORKER_CONFIG['shell'] = None
+    if process is None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+
+def run_in_worker_shell(script, stderr_file, deadline=None):
+    """在常驻bash中执行一段命令，等待哨兵行，返回其退出码
+    
+    stdout丢弃，stderr写入stderr_file。超过deadline时杀死bash并抛出TimeoutExpired，
+    bash意外退出时抛出OSError；两种情况下一次调用都会自动重启bash。
+    """
+    process = _WORKER_CONFIG.get('shell')
+    if process is None or process.poll() is not None:
+        process = start_worker_shell()
+        
+    try:
+        process.stdin.write(
+            f'{{ {script}\n}} >/dev/null 2>{shlex.quote(str(stderr_file))}; echo "{SHELL_SENTINEL} $?"\n'
+        )
+        process.stdin.flush()
+    except BrokenPipeError:
+        stop_worker_shell()
+        raise OSError("常驻bash已退出")
+        
+    while True:
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        ready, _, _ = select.select([process.stdout], [], [], timeout)
+        if not ready:
+            stop_worker_shell()
+            raise subprocess.TimeoutExpired(['bash', '(常驻进程)'], timeout)
+        line = process.stdout.readline()
+        if not line:
+            stop_worker_shell()
+            raise OSError("常驻bash意外退出")
+        if line.startswith(SHELL_SENTINEL):
+            return int(line.split()[1])
+
+
+def has_rest_data(subject_dir):
+    """被试目录中是否有REST数据，找到第一个匹配文件即返回"""
+    with os.scandir(subject_dir) as it:
+        for entry in it:
+            name = entry.name
+            if name.startswith(REST_PREFIX) and name.endswith(REST_SUFFIX):
+                return True
+    return False
+
+
+def format_error(error):
+    """格式化错误信息，wb_command失败时附上其stderr"""
+    if isinstance(error, subprocess.TimeoutExpired):
+        # 报告单文件总限时，而不是最后一条命令剩余的等待时间
+        timeout = _WORKER_CONFIG.get('timeout') or error.timeout
+        return f"{Path(error.cmd[0]).name} {error.cmd[1]} 超时（单文件限时 {timeout:.0f} 秒）"
+    message = str(error)
+    if isinstance(error, subprocess.CalledProcessError) and error.stderr:
+        message += f" ({error.stderr.decode(errors='replace').strip()})"
+    return message
+
+
+def worker_temp_dir(output_dir):
+    """返回当前工作进程存放中间GIFTI的目录
+    
+    优先使用temp_root下按进程号区分的子目录（不同被试的临时文件同名），
+    不可用或剩余空间不足时回退到输出目录。
+    """
+    temp_root = _WORKER_CONFIG.get('temp_root')
+    if temp_root:
+        temp_dir = Path(temp_root) / f'hcp_{os.getpid()}'
+        try:
+            temp_dir.mkdir(exist_ok=True)
+            if shutil.disk_usage(temp_dir).free >= TEMP_MIN_FREE_BYTES:
+                return temp_dir
+        except OSError:
+            pass
+            
+        if not _WORKER_CONFIG.get('temp_fallback_warned'):
+            _WORKER_CONFIG['temp_fallback_warned'] = True
+            logging.getLogger(__name__).warning(
+                f"工作进程 {os.getpid()} 的临时目录不可用或空间不足，中间文件改写入输出目录"
+            )
+    return Path(output_dir)
+
+
+def cifti_file_paths(cifti_path, output_dir, temp_dir=None):
+    """计算单个CIFTI文件对应的临时文件和输出文件路径"""
+    cifti_path = Path(cifti_path)
+    output_dir = Path(output_dir)
+    temp_dir = output_dir if temp_dir is None else Path(temp_dir)
+    
+    # 文件名处理
+    basename = cifti_path.stem.replace('.dtseries', '')
+    
+    return {
+        'cifti': cifti_path,
+        # 临时文件
+        'temp_left': temp_dir / f'temp_{basename}.L.32k.func.gii',
+        'temp_right': temp_dir / f'temp_{basename}.R.32k.func.gii',
+        'stderr': temp_dir / f'temp_{basename}.stderr',
+        # 输出文件
+        'output_left': output_dir / f'{basename}.L.3k_fsavg_L.func.gii',
+        'output_right': output_dir / f'{basename}.R.3k_fsavg_R.func.gii',
+    }
+
+
+def separate_command(paths, wb_command):
+    """构建把CIFTI分离为左右半球32k GIFTI的命令"""
+    return [
+        wb_command, '-cifti-separate', str(paths['cifti']), 'COLUMN',
+        '-metric', 'CORTEX_LEFT', str(paths['temp_left']),
+        '-metric', 'CORTEX_RIGHT', str(paths['temp_right'])
+    ]
+
+
+def resample_command(wb_command, metric_in, hemi, metric_out, sphere_paths, area_paths):
+    """构建32k fs_LR -> fsaverage4的ADAP_BARY_AREA重采样命令"""
+    return [
+        wb_command, '-metric-resample',
+        str(metric_in),
+        str(sphere_paths[f'fs_LR_32k_{hemi}']),
+        str(sphere_paths[f'fsavg4_{hemi}']),
+        'ADAP_BARY_AREA',
+        str(metric_out),
+        '-area-metrics',
+        str(area_paths[f'fs_LR_32k_{hemi}']),
+        str(area_paths[f'fsavg4_{hemi}'])
+    ]
+
+
+def cifti_script(paths, wb_command, sphere_paths, area_paths):
+    """生成单个CIFTI的bash命令：先分离，再同时重采样左右半球（两者读写的文件互不相交）
+    
+    任一步骤失败时整段命令的退出码非0。
+    """
+    separate = shlex.join(separate_command(paths, wb_command))
+    resample_left = shlex.join(resample_command(
+        wb_command, paths['temp_left'], 'L', paths['output_left'], sphere_paths, area_paths))
+    resample_right = shlex.join(resample_command(
+        wb_command, paths['temp_right'], 'R', paths['output_right'], sphere_paths, area_paths))
+    return (
+        f'{separate} && {{ {resample_left} & left_pid=$!; {resample_right}; right_status=$?; '
+        f'wait $left_pid && [ $right_status -eq 0 ]; }}'
+    )
+
+
+def process_in_bash(paths, wb_command, sphere_paths, area_paths, deadline=None):
+    """用一次bash调用完成分离和左右半球重采样，失败时抛出CalledProcessError
+    
+    超过deadline（time.monotonic）时杀死整个进程组（bash及其wb_command），然后抛出TimeoutExpired。
+    """
+    # 单独的会话，超时时可以连同bash启动的wb_command一起杀死
+    process = subprocess.Popen(
+        ['bash', '-c', cifti_script(paths, wb_command, sphere_paths, area_paths)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True
+    )
+    timeout = None if deadline is None else max(0, deadline - time.monotonic())
+    try:
+        _, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.communicate()
+        raise subprocess.TimeoutExpired(['bash', '(分离+重采样)'], timeout)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, wb_command, stderr=stderr)
+
+
+def surface_vertex_count(surface_path):
+    """读取球面GIFTI的顶点数"""
+    import nibabel as nib
+    
+    img = nib.load(str(surface_path))
+    return img.get_arrays_from_intent('NIFTI_INTENT_POINTSET')[0].dims[0]
+
+
+def atlas_fingerprint(atlas_paths):
+    """根据图谱文件的路径、大小和修改时间计算指纹，任一文件被替换后指纹随之改变"""
+    import hashlib
+    
+    digest = hashlib.sha1()
+    for path in atlas_paths:
+        stat = Path(path).stat()
+        digest.update(f'{Path(path).resolve()}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()[:16]
+
+
+def process_in_worker_shell(paths, wb_command, sphere_paths, area_paths, deadline=None):
+    """在常驻bash中完成分离和左右半球重采样（两个半球同时进行），失败时抛出CalledProcessError"""
+    script = cifti_script(paths, wb_command, sphere_paths, area_paths)
+    
+    stderr_file = paths['stderr']
+    try:
+        returncode = run_in_worker_shell(script, stderr_file, deadline)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode, wb_command, stderr=stderr_file.read_bytes() if stderr_file.exists() else None
+            )
+    finally:
+        stderr_file.unlink(missing_ok=True)
+
+
+def save_metric_timeseries(timeseries, output_file):
+    """将 (顶点数, 时间点数) 的数组保存为每个时间点一个数据数组的GIFTI metric文件"""
+    import numpy as np
+    import nibabel as nib
+    
+    darrays = [
+        nib.gifti.GiftiDataArray(
+            data=np.ascontiguousarray(timeseries[:, t], dtype=np.float32),
+            datatype='NIFTI_TYPE_FLOAT32'
+        )
+        for t in range(timeseries.shape[1])
+    ]
+    nib.save(nib.gifti.GiftiImage(darrays=darrays), str(output_file))
+
+
+def compute_resample_weights(wb_command, hemi, sphere_paths, area_paths, work_dir, n_source):
+    """用单位向量探测wb_command的ADAP_BARY_AREA重采样，得到稀疏权重矩阵
+    
+    ADAP_BARY_AREA的权重只由球面和面积文件决定，对数据是线性的：
+    输入第j列为单位向量时，输出就是权重矩阵的第j列。
+    n_source为32k球面的顶点数，返回形状为 (fsaverage4顶点数, n_source) 的CSR矩阵。
+    """
+    import numpy as np
+    import nibabel as nib
+    from scipy import sparse
+    
+    work_dir = Path(work_dir)
+    rows, cols, values = [], [], []
+    n_target = None
+    
+    for start in range(0, n_source, WEIGHT_PROBE_COLUMNS):
+        stop = min(start + WEIGHT_PROBE_COLUMNS, n_source)
+        probe = np.zeros((n_source, stop - start), dtype=np.float32)
+        probe[np.arange(start, stop), np.arange(stop - start)] = 1.0
+        
+        probe_in = work_dir / f'probe_{hemi}_{start}.32k.func.gii'
+        probe_out = work_dir / f'probe_{hemi}_{start}.3k.func.gii'
+        try:
+            save_metric_timeseries(probe, probe_in)
+            run_commands_concurrently([
+                resample_command(wb_command, probe_in, hemi, probe_out, sphere_paths, area_paths)
+            ])
+            for offset, darray in enumerate(nib.load(str(probe_out)).darrays):
+                column = darray.data
+                n_target = column.shape[0]
+                nonzero = np.flatnonzero(column)
+                rows.append(nonzero)
+                cols.append(np.full(nonzero.size, start + offset))
+                values.append(column[nonzero])
+        finally:
+            probe_in.unlink(missing_ok=True)
+            probe_out.unlink(missing_ok=True)
+            
+    return sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_target, n_source), dtype=np.float32
+    )
+
+
+def resample_cifti_in_process(paths, weights):
+    """内置引擎：nibabel内存映射读取dtseries，直接用预计算的权重矩阵重采样
+    
+    与-cifti-separate一致，ROI之外的顶点（内侧壁）取0后再参与重采样。
+    """
+    import numpy as np
+    import nibabel as nib
+    
+    img = nib.load(str(paths['cifti']), mmap=True)
+    structures = {
+        name: (columns, brain_model)
+        for name, columns, brain_model in img.header.get_axis(1).iter_structures()
+    }
+    
+    for hemi, output_key in [('L', 'output_left'), ('R', 'output_right')]:
+        name = CIFTI_STRUCTURES[hemi]
+        if name not in structures:
+            raise ValueError(f"CIFTI文件中没有 {name}")
+        columns, brain_model = structures[name]
+        weight = weights[hemi]
+        
+        if brain_model.nvertices[name] != weight.shape[1]:
+            raise ValueError(f"{name} 顶点数 {brain_model.nvertices[name]} 与重采样权重 {weight.shape[1]} 不一致")
+            
+        cortex = np.asarray(img.dataobj[:, columns], dtype=np.float32)
+        full = np.zeros((weight.shape[1], cortex.shape[0]), dtype=np.float32)
+        full[brain_model.vertex] = cortex.T
+        
+        save_metric_timeseries(weight @ full, paths[output_key])
+
+
+def process_cifti_file(cifti_path, output_dir):
+    """处理单个CIFTI文件（在工作进程中执行，需先调用init_worker）
+    
+    已处理文件由驱动进程在提交前根据输出目录列表过滤掉。
+    wb_command引擎下分离和重采样共用一个PER_FILE_TIMEOUT截止时间。
+    """
+    weights = _WORKER_CONFIG['weights']
+    temp_dir = worker_temp_dir(output_dir) if weights is None else None
+    paths = cifti_file_paths(cifti_path, output_dir, temp_dir)
+    
+    try:
+        if weights is not None:
+            # 内置引擎：不产生中间文件，也不启动wb_command
+            resample_cifti_in_process(paths, weights)
+        else:
+            wb_command = _WORKER_CONFIG['wb_command']
+            sphere_paths = _WORKER_CONFIG['sphere_paths']
+            area_paths = _WORKER_CONFIG['area_paths']
+            deadline = file_deadline()
+            if _WORKER_CONFIG.get('persistent_shell'):
+                process_in_worker_shell(paths, wb_command, sphere_paths, area_paths, deadline)
+            else:
+                process_in_bash(paths, wb_command, sphere_paths, area_paths, deadline)
+        
+        return True, "成功"
+        
+    except (subprocess.SubprocessError, ValueError, OSError) as e:
+        # 清理可能的部分输出
+        paths['output_left'].unlink(missing_ok=True)
+        paths['output_right'].unlink(missing_ok=True)
+        return False, f"错误: {format_error(e)}"
+        
+    finally:
+        # 清理临时文件
+        paths['temp_left'].unlink(missing_ok=True)
+        paths['temp_right'].unlink(missing_ok=True)
+        # dtseries只读一次，处理完即移出页缓存
+        fadvise_file(paths['cifti'], 'POSIX_FADV_DONTNEED')
+
+
+def build_subject_script(items, wb_command, sphere_paths, area_paths):
+    """为同一被试的多个run生成一个bash脚本
+    
+    每个run依次执行分离和左右半球重采样，成功输出"OK 序号"，失败输出"FAIL 序号"，
+    某个run失败不影响后续run。各run的stderr分别写入自己的paths['stderr']。
+    """
+    lines = []
+    for index, paths in enumerate(items):
+        commands = [
+            separate_command(paths, wb_command),
+            resample_command(wb_command, paths['temp_left'], 'L', paths['output_left'], sphere_paths, area_paths),
+            resample_command(wb_command, paths['temp_right'], 'R', paths['output_right'], sphere_paths, area_paths),
+        ]
+        chain = ' && '.join(shlex.join(cmd) for cmd in commands)
+        stderr_file = shlex.quote(str(paths['stderr']))
+        # 整条命令链用{ }包起来，重定向才会作用于每一条命令而不只是最后一条
+        lines.append(f'if {{ {chain}; }} >/dev/null 2>{stderr_file}; then echo OK {index}; else echo FAIL {index}; fi')
+        lines.append(shlex.join(['rm', '-f', str(paths['temp_left']), str(paths['temp_right'])]))
+    return '\n'.join(lines) + '\n'
+
+
+def process_subject_files(cifti_paths, output_dir):
+    """在一次bash调用中处理同一被试的所有待处理run，返回 [(成功, 信息), ...]
+    
+    总超时为PER_FILE_TIMEOUT乘以run数；超时时杀死整个进程组（bash及其wb_command），
+    已输出OK的run仍记为成功。失败的run只附上它自己的stderr。
+    """
+    temp_dir = worker_temp_dir(output_dir)
+    items = [cifti_file_paths(cifti_path, output_dir, temp_dir) for cifti_path in cifti_paths]
+    script = build_subject_script(
+        items, _WORKER_CONFIG['wb_command'], _WORKER_CONFIG['sphere_paths'], _WORKER_CONFIG['area_paths']
+    )
+    
+    timeout = _WORKER_CONFIG.get('timeout')
+    timed_out = False
+    
+    try:
+        # 单独的会话，超时时可以连同bash启动的wb_command一起杀死
+        process = subprocess.Popen(
+            ['bash', '-c', script], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, start_new_session=True
+        )
+        try:
+            stdout, _ = process.communicate(timeout=timeout * len(items) if timeout else None)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            os.killpg(process.pid, signal.SIGKILL)
+            stdout, _ = process.communicate()
+            
+        stderrs = [
+            paths['stderr'].read_bytes().decode(errors='replace').strip() if paths['stderr'].exists() else ''
+            for paths in items
+        ]
+    finally:
+        for paths in items:
+            paths['temp_left'].unlink(missing_ok=True)
+            paths['temp_right'].unlink(missing_ok=True)
+            paths['stderr'].unlink(missing_ok=True)
+            fadvise_file(paths['cifti'], 'POSIX_FADV_DONTNEED')
+            
+    status = {}
+    for line in stdout.decode(errors='replace').splitlines():
+        if line.startswith(('OK ', 'FAIL ')):
+            result, index = line.split()
+            status[int(index)] = result
+    
+    results = []
+    for index, (paths, stderr) in enumerate(zip(items, stderrs)):
+        if status.get(index) == 'OK':
+            results.append((True, "成功"))
+            continue
+            
+        # 清理可能的部分输出
+        paths['output_left'].unlink(missing_ok=True)
+        paths['output_right'].unlink(missing_ok=True)
+        if timed_out and index not in status:
+            message = f"错误: 超时（被试总限时 {timeout * len(items):.0f} 秒）"
+        else:
+            message = "错误: wb_command失败"
+        results.append((False, f"{message} ({stderr})" if stderr else message))
+    return results
+
+
+def process_task(task):
+    """进程池任务入口：task为 (被试ID, CIFTI路径列表, 输出目录)
+    
+    按被试合并脚本时整个列表在一次bash调用中处理，否则逐个文件处理。
+    任何异常都转为失败结果返回，避免中断imap_unordered的结果迭代。
+    """
+    subject, cifti_paths, output_dir = task
+    
+    if _WORKER_CONFIG.get('subject_script') and _WORKER_CONFIG['weights'] is None:
+        try:
+            outcomes = process_subject_files(cifti_paths, output_dir)
+        except Exception as e:
+            outcomes = [(False, f"错误: {format_error(e)}")] * len(cifti_paths)
+    else:
+        outcomes = []
+        for cifti_path in cifti_paths:
+            try:
+                outcomes.append(process_cifti_file(cifti_path, output_dir))
+            except Exception as e:
+                outcomes.append((False, f"错误: {format_error(e)}"))
+                
+    return [
+        (subject, Path(cifti_path).name, success, message)
+        for cifti_path, (success, message) in zip(cifti_paths, outcomes)
+    ]
+
 
 class HCPRestResampler:
     def __init__(self, config):
@@ -72,12 +718,16 @@ class HCPRestResampler:
         """检查必需的文件和程序"""
         self.logger.info("检查必需文件...")
         
-        # 检查wb_command
+        # 检查wb_command，并记录其绝对路径供工作进程直接使用
+        wb_command = shutil.which('wb_command')
         try:
-            subprocess.run(['wb_command', '-version'], capture_output=True, check=True)
+            if wb_command is None:
+                raise FileNotFoundError('wb_command')
+            subprocess.run([wb_command, '-version'], capture_output=True, check=True)
         except (subprocess.CalledProcessError, FileNotFoundError):
             self.logger.error("wb_command未找到！请安装Connectome Workbench")
             return False
+        self.wb_command = wb_command
             
         # 检查球面和面积文件
         all_files_exist = True
@@ -92,120 +742,134 @@ class HCPRestResampler:
         """查找所有包含REST数据的被试"""
         subjects = []
         
-        for subject_dir in self.input_dir.iterdir():
-            if subject_dir.is_dir():
-                # 检查是否有REST数据
-                rest_files = list(subject_dir.glob('rfMRI_REST*_Atlas_hp2000_clean.dtseries.nii'))
-                if rest_files:
-                    subjects.append(subject_dir.name)
+        with os.scandir(self.input_dir) as it:
+            for entry in it:
+                # 先按名称过滤掉非被试目录，再检查是否有REST数据
+                if SUBJECT_RE.fullmatch(entry.name) and entry.is_dir() and has_rest_data(entry.path):
+                    subjects.append(entry.name)
                     
         self.logger.info(f"找到 {len(subjects)} 个包含REST数据的被试")
         return subjects
         
-    def process_cifti_file(self, cifti_path, output_dir):
-        """处理单个CIFTI文件"""
-        cifti_path = Path(cifti_path)
-        output_dir = Path(output_dir)
-        
-        # 文件名处理
-        basename = cifti_path.stem.replace('.dtseries', '')
+    def prepare_resample_weights(self, work_dir=None):
+        """生成（或复用已缓存的）左右半球ADAP_BARY_AREA重采样权重，返回.npz路径
         
-        # 临时文件
-        temp_left = output_dir / f'temp_{basename}.L.32k.func.gii'
-        temp_right = output_dir / f'temp_{basename}.R.32k.func.gii'
+        权重文件名带有该半球球面和面积文件的指纹，图谱文件被替换（即使顶点数不变）后
+        自动重新生成，旧指纹的权重文件随之删除。
+        """
+        from scipy import sparse
         
-        # 输出文件
-        output_left = output_dir / f'{basename}.L.3k_fsavg_L.func.gii'
-        output_right = output_dir / f'{basename}.R.3k_fsavg_R.func.gii'
+        weight_dir = self.output_dir / 'resample_weights'
+        weight_dir.mkdir(parents=True, exist_ok=True)
         
-        # 检查是否已处理
-        if output_left.exists() and output_right.exists():
-            return True, "已存在"
+        weight_paths = {}
+        for hemi in ['L', 'R']:
+            keys = [f'fs_LR_32k_{hemi}', f'fsavg4_{hemi}']
+            fingerprint = atlas_fingerprint(
+                [self.sphere_paths[key] for key in keys] + [self.area_paths[key] for key in keys]
+            )
+            prefix = f'fs_LR_32k_to_fsavg4.{hemi}.ADAP_BARY_AREA'
+            weight_file = weight_dir / f'{prefix}.{fingerprint}.npz'
             
-        try:
-            # 步骤1：分离CIFTI
-            cmd_separate = [
-                'wb_command', '-cifti-separate', str(cifti_path), 'COLUMN',
-                '-metric', 'CORTEX_LEFT', str(temp_left),
-                '-metric', 'CORTEX_RIGHT', str(temp_right)
-            ]
-            subprocess.run(cmd_separate, check=True, capture_output=True)
-            
-            # 步骤2：重采样左半球
-            cmd_resample_left = [
-                'wb_command', '-metric-resample',
-                str(temp_left),
-                str(self.sphere_paths['fs_LR_32k_L']),
-                str(self.sphere_paths['fsavg4_L']),
-                'ADAP_BARY_AREA',
-                str(output_left),
-                '-area-metrics',
-                str(self.area_paths['fs_LR_32k_L']),
-                str(self.area_paths['fsavg4_L'])
-            ]
-            subprocess.run(cmd_resample_left, check=True, capture_output=True)
+            if not weight_file.exists():
+                for stale_file in weight_dir.glob(f'{prefix}*.npz'):
+                    self.logger.warning(f"{hemi}半球图谱文件已变化，删除旧的重采样权重: {stale_file.name}")
+                    stale_file.unlink()
+                    
+                self.logger.info(f"生成{hemi}半球重采样权重...")
+                weights = compute_resample_weights(
+                    self.wb_command, hemi, self.sphere_paths, self.area_paths,
+                    work_dir or weight_dir, surface_vertex_count(self.sphere_paths[f'fs_LR_32k_{hemi}'])
+                )
+                sparse.save_npz(weight_file, weights)
+            weight_paths[hemi] = str(weight_file)
             
-            # 步骤3：重采样右半球
-            cmd_resample_right = [
-                'wb_command', '-metric-resample',
-                str(temp_right),
-                str(self.sphere_paths['fs_LR_32k_R']),
-                str(self.sphere_paths['fsavg4_R']),
-                'ADAP_BARY_AREA',
-                str(output_right),
-                '-area-metrics',
-                str(self.area_paths['fs_LR_32k_R']),
-                str(self.area_paths['fsavg4_R'])
-            ]
-            subprocess.run(cmd_resample_right, check=True, capture_output=True)
+        self.logger.info(f"重采样权重: {weight_dir}")
+        return weight_paths
+        
+    def share_resample_weights(self, weight_paths, shared_blocks):
+        """加载重采样权重并放入共享内存，新建的共享内存块追加到shared_blocks"""
+        from scipy import sparse
+        
+        weight_specs = {}
+        for hemi, weight_file in weight_paths.items():
+            blocks, weight_specs[hemi] = share_sparse_matrix(sparse.load_npz(weight_file).tocsr())
+            shared_blocks.extend(blocks)
+        return weight_specs
+        
+    def create_temp_root(self):
+        """在TEMP_DIR下创建本次运行的临时目录，不可用时返回None（临时文件写入输出目录）"""
+        temp_dir = self.config.get('TEMP_DIR')
+        if not temp_dir:
+            return None
             
-            # 清理临时文件
-            temp_left.unlink(missing_ok=True)
-            temp_right.unlink(missing_ok=True)
+        try:
+            temp_root = tempfile.mkdtemp(prefix='hcp_resample_', dir=temp_dir)
+        except OSError as e:
+            self.logger.warning(f"无法使用临时目录 {temp_dir}，中间文件将写入输出目录: {e}")
+            return None
             
-            return True, "成功"
+        self.logger.info(f"中间文件目录: {temp_root}")
+        return temp_root
+        
+    def probe_input_bandwidth(self, subjects):
+        """顺序读取一个REST文件的前IO_PROBE_BYTES字节，估计输入盘读带宽（MB/s）"""
+        for subject in subjects:
+            rest_files = sorted((self.input_dir / subject).glob(REST_PATTERN))
+            if rest_files:
+                probe_file = rest_files[0]
+                break
+        else:
+            return None
             
-        except subprocess.CalledProcessError as e:
-            # 清理可能的部分输出
-            for f in [temp_left, temp_right, output_left, output_right]:
-                f.unlink(missing_ok=True)
-            return False, f"错误: {str(e)}"
+        fd = os.open(str(probe_file), os.O_RDONLY)
+        try:
+            # 尽量丢弃页缓存，避免测到的是内存速度
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                
+            n_read = 0
+            start = time.perf_counter()
+            while n_read < IO_PROBE_BYTES:
+                chunk = os.read(fd, 4 * 1024 * 1024)
+                if not chunk:
+                    break
+                n_read += len(chunk)
+            elapsed = time.perf_counter() - start
+        finally:
+            os.close(fd)
             
-    def process_subject(self, subject):
-        """处理单个被试的所有REST文件"""
-        subject_dir = self.input_dir / subject
-        output_dir = self.output_dir / subject
-        output_dir.mkdir(parents=True, exist_ok=True)
+        # 文件太小时测不出有意义的带宽
+        if n_read < IO_PROBE_BYTES // 10 or elapsed <= 0:
+            return None
+        return n_read / (1024 * 1024) / elapsed
         
-        # 查找REST文件
-        rest_files = list(subject_dir.glob('rfMRI_REST*_Atlas_hp2000_clean.dtseries.nii'))
+    def tune_parallel_jobs(self, subjects):
+        """根据输入盘读带宽调整并行任务数，慢速盘上过多进程只会造成磁头来回寻道"""
+        try:
+            bandwidth = self.probe_input_bandwidth(subjects)
+        except OSError:
+            bandwidth = None
+        jobs = self.config['PARALLEL_JOBS']
         
-        if not rest_files:
-            return subject, 0, 0, "未找到REST文件"
+        if bandwidth is None:
+            self.logger.warning("读带宽探测失败，保持并行任务数不变")
+            return
             
-        success_count = 0
-        results = []
-        
-        for cifti_file in rest_files:
-            success, message = self.process_cifti_file(cifti_file, output_dir)
-            if success:
-                success_count += 1
-            results.append((cifti_file.name, success, message))
+        if bandwidth < IO_FAST_DISK_MBPS:
+            jobs = max(1, min(jobs, int(bandwidth / IO_MBPS_PER_WORKER)))
             
-        # 创建处理摘要
-        summary_file = output_dir / 'processing_summary.txt'
-        with open(summary_file, 'w') as f:
-            f.write(f"被试静息态数据重采样摘要\n")
-            f.write(f"=======================\n")
-            f.write(f"被试ID: {subject}\n")
-            f.write(f"处理时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"成功处理: {success_count}/{len(rest_files)}\n\n")
-            f.write(f"文件处理详情:\n")
-            for filename, success, message in results:
-                status = "✓" if success else "✗"
-                f.write(f"{status} {filename}: {message}\n")
-                
-        return subject, success_count, len(rest_files), "完成"
+        self.logger.info(f"输入盘读带宽约 {bandwidth:.0f} MB/s，并行任务数: {self.config['PARALLEL_JOBS']} -> {jobs}")
+        self.config['PARALLEL_JOBS'] = jobs
+        
+    def open_file_log(self):
+        """以追加模式打开所有被试共用的逐文件处理记录CSV，返回 (文件对象, csv.writer)"""
+        log_file = self.output_dir / FILE_LOG_NAME
+        f = open(log_file, 'a', newline='', encoding='utf-8')
+        writer = csv.writer(f)
+        if f.tell() == 0:
+            writer.writerow(FILE_LOG_FIELDS)
+        return f, writer
         
     def run(self):
         """运行批处理"""
@@ -227,34 +891,136 @@ class HCPRestResampler:
         # 创建输出目录
         self.output_dir.mkdir(parents=True, exist_ok=True)
         
+        if self.config.get('IO_PROBE'):
+            self.tune_parallel_jobs(subjects)
+            
+        # 任务单位为(被试, REST文件)，避免多run被试拖慢批处理末尾
+        tasks = []
+        file_sizes = {}
+        subject_results = {subject: [] for subject in subjects}
+        
+        for subject in subjects:
+            subject_output_dir = self.output_dir / subject
+            subject_output_dir.mkdir(parents=True, exist_ok=True)
+            
+            # 每个被试只列一次输出目录，代替每个文件两次exists()
+            with os.scandir(subject_output_dir) as it:
+                existing = {entry.name for entry in it}
+                
+            for cifti_file in sorted((self.input_dir / subject).glob(REST_PATTERN)):
+                paths = cifti_file_paths(cifti_file, subject_output_dir)
+                if paths['output_left'].name in existing and paths['output_right'].name in existing:
+                    subject_results[subject].append((cifti_file.name, True, "已存在"))
+                else:
+                    tasks.append((subject, cifti_file))
+                    file_sizes[cifti_file] = cifti_file.stat().st_size
+                    
+        # 从大到小派发（LPT），避免最大的文件最后才开始、拖长批处理末尾
+        tasks.sort(key=lambda task: file_sizes[task[1]], reverse=True)
+        
+        n_existing = sum(len(results) for results in subject_results.values())
+        if n_existing:
+            self.logger.info(f"跳过 {n_existing} 个已处理的文件")
+            
         # 并行处理
-        self.logger.info(f"开始处理 {len(subjects)} 个被试（并行任务数: {self.config['PARALLEL_JOBS']}）")
+        self.logger.info(f"开始处理 {len(subjects)} 个被试的 {len(tasks)} 个文件（并行任务数: {self.config['PARALLEL_JOBS']}）")
+        
+        # 分离与重采样之间的中间GIFTI放在内存文件系统，避免写回硬盘再读出
+        temp_root = self.create_temp_root()
         
+        shared_blocks = []
+        
+        # 工作进程的日志经队列交给驱动进程，由本进程已有的文件/终端handler写出
+        log_queue = multiprocessing.Queue()
+        log_listener = logging.handlers.QueueListener(
+            log_queue, *logging.getLogger().handlers, respect_handler_level=True
+        )
+        log_listener.start()
+        
+        try:
+            # 内置引擎：启动时一次性准备好左右半球的重采样权重，放入共享内存供所有工作进程零拷贝使用
+            weight_specs = None
+            if self.config.get('ENGINE') == 'python':
+                try:
+                    weight_paths = self.prepare_resample_weights(temp_root)
+                    weight_specs = self.share_resample_weights(weight_paths, shared_blocks)
+                except (subprocess.CalledProcessError, ImportError, ValueError, OSError) as e:
+                    self.logger.error(f"生成重采样权重失败: {format_error(e)}")
+                    return
+                    
+            # wb_command及球面/面积路径通过initializer每个进程只传一次
+            initargs = (
+                self.wb_command,
+                {k: str(v) for k, v in self.sphere_paths.items()},
+                {k: str(v) for k, v in self.area_paths.items()},
+                temp_root,
+                weight_specs,
+                self.config.get('SUBJECT_SCRIPT', False),
+                self.config.get('PER_FILE_TIMEOUT') or None,
+                log_queue,
+                self.config.get('PERSISTENT_SHELL', False),
+            )
+            
+            if self.config.get('SUBJECT_SCRIPT') and weight_specs is None:
+                # 同一被试的所有run合并为一个任务，在一次bash调用中完成
+                subject_files = {}
+                for subject, cifti_file in tasks:
+                    subject_files.setdefault(subject, []).append(str(cifti_file))
+                task_args = [
+                    (subject, cifti_files, str(self.output_dir / subject))
+                    for subject, cifti_files in subject_files.items()
+                ]
+                # 按被试待处理文件的总大小从大到小派发
+                task_args.sort(key=lambda args: sum(file_sizes[Path(f)] for f in args[1]), reverse=True)
+            else:
+                task_args = [
+                    (subject, [str(cifti_file)], str(self.output_dir / subject))
+                    for subject, cifti_file in tasks
+                ]
+            
+            # 逐个派发任务，保证按上面的大小顺序领取（成块派发会把大小任务打包在一起，抵消LPT排序）。
+            # 每个任务耗时以秒计，逐个派发多出的进程间通信开销可以忽略
+            jobs = self.config['PARALLEL_JOBS']
+            
+            # 逐文件结果写入同一个CSV，代替每个被试目录下的小摘要文件
+            log_file, log_writer = self.open_file_log()
+            with log_file:
+                now = datetime.now().isoformat(timespec='seconds')
+                for subject, results in subject_results.items():
+                    for filename, success, message in results:
+                        log_writer.writerow([now, subject, filename, success, message])
+                        
+                with multiprocessing.Pool(jobs, initializer=init_worker, initargs=initargs) as pool:
+                    # 使用进度条
+                    with tqdm(total=len(tasks), desc="处理进度") as pbar:
+                        for task_results in pool.imap_unordered(process_task, task_args, chunksize=1):
+                            for subject, filename, success, message in task_results:
+                                if not success:
+                                    self.logger.error(f"处理文件 {subject}/{filename} 失败: {message}")
+                                subject_results[subject].append((filename, success, message))
+                                log_writer.writerow([
+                                    datetime.now().isoformat(timespec='seconds'),
+                                    subject, filename, success, message
+                                ])
+                                pbar.set_postfix({'当前': subject, '状态': '成功' if success else '失败'})
+                                pbar.update(1)
+        finally:
+            log_listener.stop()
+            for block in shared_blocks:
+                block.close()
+                block.unlink()
+            if temp_root:
+                shutil.rmtree(temp_root, ignore_errors=True)
+            
+        # 按被试汇总结果
         successful_subjects = []
         failed_subjects = []
         
-        with ProcessPoolExecutor(max_workers=self.config['PARALLEL_JOBS']) as executor:
-            # 提交任务
-            future_to_subject = {
-                executor.submit(self.process_subject, subject): subject 
-                for subject in subjects
-            }
-            
-            # 使用进度条
-            with tqdm(total=len(subjects), desc="处理进度") as pbar:
-                for future in as_completed(future_to_subject):
-                    subject = future_to_subject[future]
-                    try:
-                        subject_id, success_count, total_count, status = future.result()
-                        if success_count == total_count:
-                            successful_subjects.append(subject_id)
-                        else:
-                            failed_subjects.append(subject_id)
-                        pbar.set_postfix({'当前': subject_id, '状态': f'{success_count}/{total_count}'})
-                    except Exception as e:
-                        self.logger.error(f"处理被试 {subject} 时出错: {str(e)}")
-                        failed_subjects.append(subject)
-                    pbar.update(1)
+        for subject, results in subject_results.items():
+            if all(success for _, success, _ in results):
+                successful_subjects.append(subject)
+            else:
+                failed_subjects.append(subject)
                     
         # 生成总报告
         self.generate_summary_report(successful_subjects, failed_subjects, len(subjects))
@@ -268,7 +1034,8 @@ class HCPRestResampler:
             f.write("============================\n")
             f.write(f"处理时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
             f.write(f"输入目录: {self.input_dir}\n")
-            f.write(f"输出目录: {self.output_dir}\n\n")
+            f.write(f"输出目录: {self.output_dir}\n")
+            f.write(f"逐文件记录: {self.output_dir / FILE_LOG_NAME}\n\n")
             f.write(f"处理结果:\n")
             f.write(f"- 总被试数: {total_subjects}\n")
             f.write(f"- 成功: {len(successful_subjects)}\n")
@@ -302,6 +1069,18 @@ def main():
                         help='standard_mesh_atlases路径')
     parser.add_argument('-j', '--jobs', type=int, default=CONFIG['PARALLEL_JOBS'],
                         help='并行任务数')
+    parser.add_argument('--io-probe', action='store_true',
+                        help='先测量输入盘读带宽，慢速盘上自动减少并行任务数')
+    parser.add_argument('--subject-script', action='store_true',
+                        help='wb_command引擎下每个被试的所有run在一次bash调用中处理')
+    parser.add_argument('--persistent-shell', action='store_true',
+                        help='wb_command引擎下每个工作进程使用一个常驻bash执行命令')
+    parser.add_argument('--per-file-timeout', type=float, default=CONFIG['PER_FILE_TIMEOUT'],
+                        help='单个文件wb_command调用的超时秒数，超时则杀死并记为失败（0表示不限制）')
+    parser.add_argument('--engine', choices=ENGINES, default=CONFIG['ENGINE'],
+                        help='重采样引擎：wb_command，或python（nibabel读取+预计算稀疏权重，需要scipy）')
+    parser.add_argument('--temp-dir', default=CONFIG['TEMP_DIR'],
+                        help='中间GIFTI文件目录（默认/dev/shm，可用HCP_TMP环境变量设置）')
     
     args = parser.parse_args()
     
@@ -310,7 +1089,13 @@ def main():
         'INPUT_DIR': args.input,
         'OUTPUT_DIR': args.output,
         'ATLAS_PATH': args.atlas,
-        'PARALLEL_JOBS': args.jobs
+        'PARALLEL_JOBS': args.jobs,
+        'TEMP_DIR': args.temp_dir,
+        'ENGINE': args.engine,
+        'IO_PROBE': args.io_probe,
+        'SUBJECT_SCRIPT': args.subject_script,
+        'PERSISTENT_SHELL': args.persistent_shell,
+        'PER_FILE_TIMEOUT': args.per_file_timeout,
     }
     
     # 运行处理
@@ -12,23 +12,153 @@ HCP半球数据合并脚本
 """
 
 import os
+import re
 import sys
 import numpy as np
 import nibabel as nib
 import json
+import tempfile
 import argparse
 from pathlib import Path
 from datetime import datetime
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
+# 文件名解析：session、相位编码方向和半球，例如
+# rfMRI_REST1_LR_Atlas_hp2000_clean.L.3k_fsavg_L.func.gii -> REST1_LR_L
+FILENAME_RE = re.compile(r'REST(?P<session>[12])_(?P<direction>LR|RL).*?\.(?P<hemi>[LR])\.')
+
+# 要合并的 (左半球键, 右半球键, 合并后键)
+MERGE_PAIRS = [
+    ('REST1_LR_L', 'REST1_LR_R', 'REST1_LR_bilateral'),
+    ('REST1_RL_L', 'REST1_RL_R', 'REST1_RL_bilateral'),
+    ('REST2_LR_L', 'REST2_LR_R', 'REST2_LR_bilateral'),
+    ('REST2_RL_L', 'REST2_RL_R', 'REST2_RL_bilateral')
+]
+
+# numba编译的函数 {名称: 函数}，首次使用时创建；numba不可用时为False
+_NUMBA_KERNELS = None
+
+
+def _get_numba_kernel(name):
+    """返回numba编译的 copy_row_stats 函数，numba不可用时返回None"""
+    global _NUMBA_KERNELS
+    if _NUMBA_KERNELS is None:
+        try:
+            from numba import njit
+        except ImportError:
+            _NUMBA_KERNELS = False
+        else:
+            @njit(cache=True)
+            def copy_row_stats_kernel(src, dst):
+                # 复制一个时间点的数据，同时统计NaN/Inf个数和最小/最大值
+                n_nan = 0
+                n_inf = 0
+                mn = np.inf
+                mx = -np.inf
+                for j in range(src.shape[0]):
+                    v = src[j]
+                    dst[j] = v
+                    if np.isnan(v):
+                        n_nan += 1
+                    else:
+                        if np.isinf(v):
+                            n_inf += 1
+                        mn = min(mn, v)
+                        mx = max(mx, v)
+                return n_nan, n_inf, mn, mx
+            
+            _NUMBA_KERNELS = {
+                'copy_row_stats': copy_row_stats_kernel,
+            }
+    return _NUMBA_KERNELS[name] if _NUMBA_KERNELS else None
+
+
+def stats_to_checks(n_nan, n_inf, lo, hi):
+    """把 (NaN个数, Inf个数, 最小值, 最大值) 转为finite_minmax的返回格式"""
+    if n_nan:
+        lo = hi = np.nan
+    return n_nan == 0, n_inf == 0, float(lo), float(hi)
+
+
+def finite_minmax(ts):
+    """返回 (无NaN, 无Inf, 最小值, 最大值)，最小/最大值与ts.min()/ts.max()一致
+    
+    只在加载时没有统计数值（numba不可用）时调用。只做min/max两次扫描：NaN会传播到min，
+    Inf会出现在极值中，只有存在NaN时才需要额外检查Inf。
+    """
+    lo, hi = float(ts.min()), float(ts.max())
+    no_nan = not np.isnan(lo)
+    no_inf = np.isfinite(hi) and np.isfinite(lo) if no_nan else not np.isinf(ts).any()
+    return no_nan, bool(no_inf), lo, hi
+
+
+def list_gifti_files(subject_dir):
+    """用一次scandir列出被试目录下的 *.func.gii 文件（与glob一致，忽略以.开头的文件）"""
+    with os.scandir(subject_dir) as it:
+        return [
+            Path(entry.path) for entry in it
+            if entry.name.endswith('.func.gii') and not entry.name.startswith('.') and entry.is_file()
+        ]
+
+
+def format_merge_summary(merged_info):
+    """把被试各run的合并信息拼成一行日志，例如 REST1_LR_bilateral (1200, 2562+2562)"""
+    return ', '.join(
+        f"{key} ({info['n_timepoints']}, {info['n_vertices_left']}+{info['n_vertices_right']})"
+        for key, info in merged_info.items()
+    )
+
+
+def load_merged(path):
+    """以内存映射方式读取合并后的 .npy 文件，返回只读的np.memmap
+    
+    不会把整个 (时间点, 顶点) 数组读入内存，只取部分时间窗或顶点时只读取相应的页。
+    """
+    return np.load(path, mmap_mode='r')
+
+
+def partial_path(path):
+    """合并过程中 .npy 文件的临时名，写完并刷新后才改名为path，中断时不会在path留下只写了一部分的文件"""
+    path = Path(path)
+    return path.with_name(f'.{path.name}.partial')
+
+
+def write_json_atomic(path, obj):
+    """先写入同目录下的临时文件再改名，中断时不会留下不完整的JSON"""
+    path = Path(path)
+    with tempfile.NamedTemporaryFile('w', dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp', delete=False) as f:
+        json.dump(obj, f, indent=2)
+    os.replace(f.name, path)
+
+
+# 工作进程内的处理器，由_init_worker在每个进程启动时设置一次
+_WORKER_PROCESSOR = None
+
+
+def _init_worker(processor):
+    """进程池initializer：每个工作进程只接收一次处理器，避免每个被试重新初始化（新建日志文件）"""
+    global _WORKER_PROCESSOR
+    _WORKER_PROCESSOR = processor
+
+
+def _process_subject(subject_id, save_formats, gifti_files=None):
+    """进程池任务入口：处理单个被试，只返回 (成功, 错误信息)，不把合并后的数组传回主进程"""
+    success, result = _WORKER_PROCESSOR.process_subject(subject_id, save_formats, gifti_files)
+    return success, None if success else result
+
+
 class HCPBilateralProcessor:
     """HCP双侧数据处理器"""
     
-    def __init__(self, input_dir, output_dir, verbose=True):
+    def __init__(self, input_dir, output_dir, verbose=True, force=False):
         self.input_dir = Path(input_dir)
         self.output_dir = Path(output_dir)
         self.verbose = verbose
+        # 为True时即使被试输出已完整也重新处理
+        self.force = force
         
         # 创建输出目录
         self.output_dir.mkdir(parents=True, exist_ok=True)
@@ -36,6 +166,9 @@ class HCPBilateralProcessor:
         # 设置日志
         self.setup_logging()
         
+        # find_subjects得到的 {被试ID: GIFTI文件列表}，处理时不必再次列目录
+        self.subject_files = {}
+        
         # 文件模式定义
         self.file_patterns = {
             'REST1_LR': 'rfMRI_REST1_LR_Atlas_hp2000_clean',
@@ -63,63 +196,115 @@ class HCPBilateralProcessor:
         self.logger = logging.getLogger(__name__)
     
     def find_subjects(self):
-        """查找所有可用的被试"""
-        subjects = []
-        
-        for subject_dir in self.input_dir.iterdir():
-            if subject_dir.is_dir():
-                # 检查是否有GIFTI文件
-                gifti_files = list(subject_dir.glob("*.func.gii"))
-                if gifti_files:
-                    subjects.append(subject_dir.name)
-        
+        """查找所有可用的被试，同时记录每个被试的GIFTI文件列表"""
+        self.subject_files = {}
+        
+        with os.scandir(self.input_dir) as it:
+            for entry in it:
+                if entry.is_dir():
+                    # 检查是否有GIFTI文件
+                    gifti_files = list_gifti_files(entry.path)
+                    if gifti_files:
+                        self.subject_files[entry.name] = gifti_files
+        
+        subjects = sorted(self.subject_files)
         self.logger.info(f"找到 {len(subjects)} 个被试目录")
-        return sorted(subjects)
+        return subjects
     
     def parse_filename(self, filename):
-        """解析文件名获取键值"""
-        # 解析文件名模式
-        patterns = {
-            'REST1_LR_L': ['REST1', 'LR', '.L.'],
-            'REST1_LR_R': ['REST1', 'LR', '.R.'],
-            'REST1_RL_L': ['REST1', 'RL', '.L.'],
-            'REST1_RL_R': ['REST1', 'RL', '.R.'],
-            'REST2_LR_L': ['REST2', 'LR', '.L.'],
-            'REST2_LR_R': ['REST2', 'LR', '.R.'],
-            'REST2_RL_L': ['REST2', 'RL', '.L.'],
-            'REST2_RL_R': ['REST2', 'RL', '.R.']
-        }
+        """解析文件名获取键值（如 REST1_LR_L），不匹配时返回None"""
+        match = FILENAME_RE.search(filename)
+        if match is None:
+            return None
+        return f"REST{match['session']}_{match['direction']}_{match['hemi']}"
+    
+    def load_gifti_into(self, gii, out_view):
+        """把GIFTI的前 out_view.shape[0] 个时间点逐个填入 (时间点, 顶点) 视图
+        
+        有numba时复制的同时统计数值，返回 (NaN个数, Inf个数, 最小值, 最大值)，否则返回None。
+        """
+        kernel = _get_numba_kernel('copy_row_stats')
+        if kernel is None:
+            for t in range(out_view.shape[0]):
+                out_view[t] = gii.darrays[t].data
+            return None
         
-        for key, pattern in patterns.items():
-            if all(p in filename for p in pattern):
-                return key
-        return None
+        n_nan, n_inf, mn, mx = 0, 0, np.inf, -np.inf
+        for t in range(out_view.shape[0]):
+            row_nan, row_inf, row_min, row_max = kernel(gii.darrays[t].data, out_view[t])
+            n_nan += row_nan
+            n_inf += row_inf
+            mn = min(mn, row_min)
+            mx = max(mx, row_max)
+        return n_nan, n_inf, mn, mx
     
-    def load_gifti_timeseries(self, gifti_file):
-        """加载GIFTI文件的时间序列数据"""
+    def load_and_merge_pair(self, left_file, right_file, merged_key, out_file=None):
+        """读取一对左右半球GIFTI，直接填入预先分配的双侧数组，省去单独加载后再拼接的复制
+        
+        给定out_file时双侧数组是 partial_path(out_file) 的内存映射（np.lib.format.open_memmap），
+        合并的同时即写成最终的磁盘格式，内存中不再保留完整的合并数组；
+        save_merged_run刷新后再改名为out_file。
+        """
         try:
-            gii = nib.load(str(gifti_file))
+            left_gii = nib.load(str(left_file))
+            right_gii = nib.load(str(right_file))
             
-            # 读取所有时间点的数据
-            n_timepoints = len(gii.darrays)
-            if n_timepoints == 0:
+            if not left_gii.darrays or not right_gii.darrays:
                 raise ValueError("GIFTI文件中没有数据数组")
             
-            n_vertices = gii.darrays[0].data.shape[0]
-            
-            # 使用更高效的方法读取所有时间点
-            timeseries = np.array([darray.data for darray in gii.darrays])
-            
-            self.logger.debug(f"加载 {gifti_file.name}: {timeseries.shape}")
-            
-            return timeseries
+            n_vertices_left = left_gii.darrays[0].data.shape[0]
+            n_vertices_right = right_gii.darrays[0].data.shape[0]
+            n_timepoints = len(left_gii.darrays)
+            
+            # 检查时间点数是否匹配
+            if len(left_gii.darrays) != len(right_gii.darrays):
+                self.logger.warning(f"时间点数不匹配: {left_file.name}({len(left_gii.darrays)}) vs {right_file.name}({len(right_gii.darrays)})")
+                n_timepoints = min(len(left_gii.darrays), len(right_gii.darrays))
+                self.logger.info(f"截断到 {n_timepoints} 个时间点")
+            
+            # 一次分配双侧数组，左右半球分别填入各自的顶点区间
+            dtype = np.result_type(left_gii.darrays[0].data.dtype, right_gii.darrays[0].data.dtype)
+            shape = (n_timepoints, n_vertices_left + n_vertices_right)
+            if out_file is None:
+                merged_timeseries = np.empty(shape, dtype=dtype)
+            else:
+                Path(out_file).parent.mkdir(parents=True, exist_ok=True)
+                merged_timeseries = np.lib.format.open_memmap(partial_path(out_file), mode='w+', dtype=dtype, shape=shape)
+            left_stats = self.load_gifti_into(left_gii, merged_timeseries[:, :n_vertices_left])
+            right_stats = self.load_gifti_into(right_gii, merged_timeseries[:, n_vertices_left:])
             
         except Exception as e:
-            self.logger.error(f"加载GIFTI文件失败 {gifti_file}: {e}")
+            self.logger.error(f"加载GIFTI文件失败 {left_file.name}/{right_file.name}: {e}")
+            # 不留下只写了一部分的 .npy 文件
+            if out_file is not None:
+                partial_path(out_file).unlink(missing_ok=True)
             return None
+        
+        merged = {
+            'timeseries': merged_timeseries,
+            'filename': f"{merged_key}.func.gii",
+            'n_timepoints': merged_timeseries.shape[0],
+            'n_vertices': merged_timeseries.shape[1],
+            'n_vertices_left': n_vertices_left,
+            'n_vertices_right': n_vertices_right,
+            'left_source': left_file.name,
+            'right_source': right_file.name
+        }
+        
+        # 复制时已统计的数值信息供验证直接使用，不必再扫描一遍合并后的数组
+        if left_stats is not None and right_stats is not None:
+            merged['value_stats'] = stats_to_checks(
+                left_stats[0] + right_stats[0], left_stats[1] + right_stats[1],
+                min(left_stats[2], right_stats[2]), max(left_stats[3], right_stats[3])
+            )
+        
+        return merged
     
-    def load_subject_data(self, subject_id):
-        """加载被试的所有数据"""
+    def find_merge_pairs(self, subject_id, gifti_files=None):
+        """找出被试可合并的左右半球文件，返回 [(左半球文件, 右半球文件, 合并后键), ...]
+        
+        被试目录不存在或没有GIFTI文件时返回None。
+        """
         subject_dir = self.input_dir / subject_id
         
         if not subject_dir.exists():
@@ -128,141 +313,120 @@ class HCPBilateralProcessor:
         
         self.logger.info(f"加载被试 {subject_id} 的数据...")
         
-        data = {}
+        if gifti_files is None:
+            gifti_files = list_gifti_files(subject_dir)
         
-        # 查找所有GIFTI文件
-        gifti_files = list(subject_dir.glob("*.func.gii"))
+        gifti_files = {
+            key: gifti_file for key, gifti_file in
+            ((self.parse_filename(gifti_file.name), gifti_file) for gifti_file in gifti_files)
+            if key
+        }
         
         if not gifti_files:
             self.logger.warning(f"被试 {subject_id} 没有找到GIFTI文件")
             return None
         
-        for gifti_file in gifti_files:
-            key = self.parse_filename(gifti_file.name)
-            if key:
-                timeseries = self.load_gifti_timeseries(gifti_file)
-                if timeseries is not None:
-                    data[key] = {
-                        'timeseries': timeseries,
-                        'filename': gifti_file.name,
-                        'n_timepoints': timeseries.shape[0],
-                        'n_vertices': timeseries.shape[1]
-                    }
-                    self.logger.debug(f"  {key}: {timeseries.shape}")
-        
-        if not data:
-            self.logger.warning(f"被试 {subject_id} 没有有效的数据文件")
-            return None
-        
-        self.logger.info(f"成功加载被试 {subject_id} 的 {len(data)} 个数据文件")
-        return data
-    
-    def merge_hemispheres(self, subject_data):
-        """合并左右半球数据"""
-        merged_data = {}
-        
-        # 定义要合并的配对
-        merge_pairs = [
-            ('REST1_LR_L', 'REST1_LR_R', 'REST1_LR_bilateral'),
-            ('REST1_RL_L', 'REST1_RL_R', 'REST1_RL_bilateral'),
-            ('REST2_LR_L', 'REST2_LR_R', 'REST2_LR_bilateral'),
-            ('REST2_RL_L', 'REST2_RL_R', 'REST2_RL_bilateral')
-        ]
-        
-        for left_key, right_key, merged_key in merge_pairs:
-            if left_key in subject_data and right_key in subject_data:
-                left_data = subject_data[left_key]
-                right_data = subject_data[right_key]
-                
-                left_ts = left_data['timeseries']
-                right_ts = right_data['timeseries']
-                
-                # 检查时间点数是否匹配
-                if left_ts.shape[0] != right_ts.shape[0]:
-                    self.logger.warning(f"时间点数不匹配: {left_key}({left_ts.shape[0]}) vs {right_key}({right_ts.shape[0]})")
-                    min_timepoints = min(left_ts.shape[0], right_ts.shape[0])
-                    left_ts = left_ts[:min_timepoints, :]
-                    right_ts = right_ts[:min_timepoints, :]
-                    self.logger.info(f"截断到 {min_timepoints} 个时间点")
-                
-                # 合并数据：沿着顶点维度拼接
-                merged_timeseries = np.concatenate([left_ts, right_ts], axis=1)
-                
-                merged_data[merged_key] = {
-                    'timeseries': merged_timeseries,
-                    'filename': f"{merged_key}.func.gii",
-                    'n_timepoints': merged_timeseries.shape[0],
-                    'n_vertices': merged_timeseries.shape[1],
-                    'n_vertices_left': left_ts.shape[1],
-                    'n_vertices_right': right_ts.shape[1],
-                    'left_source': left_data['filename'],
-                    'right_source': right_data['filename']
-                }
-                
-                self.logger.info(f"✓ 合并完成: {merged_key}")
-                self.logger.info(f"  左半球: {left_ts.shape[1]} 顶点")
-                self.logger.info(f"  右半球: {right_ts.shape[1]} 顶点")
-                self.logger.info(f"  合并后: {merged_timeseries.shape}")
-                
+        pairs = []
+        for left_key, right_key, merged_key in MERGE_PAIRS:
+            if left_key in gifti_files and right_key in gifti_files:
+                pairs.append((gifti_files[left_key], gifti_files[right_key], merged_key))
             else:
-                missing = []
-                if left_key not in subject_data:
-                    missing.append(left_key)
-                if right_key not in subject_data:
-                    missing.append(right_key)
+                missing = [key for key in (left_key, right_key) if key not in gifti_files]
                 self.logger.warning(f"无法合并 {merged_key}: 缺少 {', '.join(missing)}")
         
-        return merged_data
+        return pairs
     
-    def save_merged_data(self, merged_data, subject_id, save_formats=['numpy', 'gifti']):
-        """保存合并后的数据"""
+    def save_merged_run(self, key, data, subject_id, save_formats=['numpy', 'gifti']):
+        """保存一个run合并后的时间序列，返回其元数据（由save_subject_metadata统一写出）"""
         subject_output_dir = self.output_dir / subject_id
         subject_output_dir.mkdir(parents=True, exist_ok=True)
         
-        for key, data in merged_data.items():
-            timeseries = data['timeseries']
-            
-            # 保存为numpy格式（推荐，读取速度快）
-            if 'numpy' in save_formats:
-                np_file = subject_output_dir / f"{key}.npy"
+        timeseries = data['timeseries']
+        
+        _dbg = self.logger.isEnabledFor(logging.DEBUG)
+        
+        # 保存为分块压缩的Zarr（默认），按顶点读取时间序列时只需解压相应的块
+        save_numpy = 'numpy' in save_formats
+        if 'zarr' in save_formats:
+            zarr_file = subject_output_dir / f"{key}.zarr"
+            try:
+                self.save_as_zarr(timeseries, zarr_file)
+                if _dbg:
+                    self.logger.debug(f"已保存Zarr文件: {zarr_file}")
+            except ImportError:
+                self.logger.warning("未安装zarr/numcodecs，改为保存numpy格式")
+                save_numpy = True
+        
+        # 保存为numpy格式（读取速度快，可用load_merged内存映射读取）
+        if save_numpy:
+            np_file = subject_output_dir / f"{key}.npy"
+            temp_file = partial_path(np_file)
+            if isinstance(timeseries, np.memmap) and os.path.abspath(timeseries.filename) == os.path.abspath(temp_file):
+                # 合并时已直接写入临时文件，刷新到磁盘后改名
+                timeseries.flush()
+                os.replace(temp_file, np_file)
+            else:
                 np.save(np_file, timeseries)
+            if _dbg:
                 self.logger.debug(f"已保存numpy文件: {np_file}")
-            
-            # 保存为GIFTI格式
-            if 'gifti' in save_formats:
-                gifti_file = subject_output_dir / f"{key}.func.gii"
-                self.save_as_gifti(timeseries, gifti_file, subject_id, key)
+        
+        # 保存为GIFTI格式
+        if 'gifti' in save_formats:
+            gifti_file = subject_output_dir / f"{key}.func.gii"
+            self.save_as_gifti(timeseries, gifti_file, subject_id, key)
+            if _dbg:
                 self.logger.debug(f"已保存GIFTI文件: {gifti_file}")
-            
-            # 保存元数据
-            metadata = {k: v for k, v in data.items() if k != 'timeseries'}
-            metadata['subject_id'] = subject_id
-            metadata['merge_date'] = datetime.now().isoformat()
-            metadata['data_shape'] = list(timeseries.shape)
-            metadata['data_dtype'] = str(timeseries.dtype)
-            
-            meta_file = subject_output_dir / f"{key}_metadata.json"
-            with open(meta_file, 'w') as f:
-                json.dump(metadata, f, indent=2)
-            
-            self.logger.info(f"已保存: {key} -> {subject_output_dir}")
+        
+        # 元数据
+        metadata = {k: v for k, v in data.items() if k not in ('timeseries', 'value_stats')}
+        metadata['subject_id'] = subject_id
+        metadata['merge_date'] = datetime.now().isoformat()
+        metadata['data_shape'] = list(timeseries.shape)
+        metadata['data_dtype'] = str(timeseries.dtype)
+        
+        if _dbg:
+            self.logger.debug(f"已保存: {key} -> {subject_output_dir}")
+        return metadata
+    
+    def save_as_zarr(self, timeseries, output_file):
+        """将时间序列保存为Blosc(zstd)压缩的Zarr数组，每个块包含完整时间轴和至多1024个顶点
+        
+        zarr和numcodecs只在使用时导入，未安装时抛出ImportError。
+        """
+        import zarr
+        
+        n_timepoints, n_vertices = timeseries.shape
+        chunks = (n_timepoints, min(1024, n_vertices))
+        
+        if hasattr(zarr, 'create_array'):
+            # zarr 3.x
+            from zarr.codecs import BloscCodec
+            z = zarr.create_array(
+                store=str(output_file), shape=timeseries.shape, chunks=chunks, dtype='float32',
+                compressors=BloscCodec(cname='zstd', clevel=3, shuffle='shuffle'), overwrite=True
+            )
+        else:
+            import numcodecs
+            z = zarr.open(
+                str(output_file), mode='w', shape=timeseries.shape, chunks=chunks, dtype='float32',
+                compressor=numcodecs.Blosc(cname='zstd', clevel=3, shuffle=numcodecs.Blosc.SHUFFLE)
+            )
+        
+        z[:] = timeseries
     
     def save_as_gifti(self, timeseries, output_file, subject_id, data_key):
         """将时间序列保存为GIFTI格式"""
         try:
-            # 创建GIFTI数据数组列表
-            darrays = []
-            
-            for t in range(timeseries.shape[0]):
-                darray = nib.gifti.GiftiDataArray(
-                    data=timeseries[t, :].astype(np.float32),
-                    intent=nib.nifti1.intent_codes['NIFTI_INTENT_TIME_SERIES'],
-                    datatype=nib.nifti1.data_type_codes['NIFTI_TYPE_FLOAT32']
-                )
-                darrays.append(darray)
+            # 整体转换一次为连续的float32（已是float32时不复制），循环内只取行视图
+            ts32 = np.ascontiguousarray(timeseries, dtype=np.float32)
+            intent = nib.nifti1.intent_codes['NIFTI_INTENT_TIME_SERIES']
+            datatype = nib.nifti1.data_type_codes['NIFTI_TYPE_FLOAT32']
             
-            # 创建GIFTI图像
-            gii_img = nib.gifti.GiftiImage(darrays=darrays)
+            # 创建GIFTI图像，每个时间点一个数据数组
+            gii_img = nib.gifti.GiftiImage(darrays=[
+                nib.gifti.GiftiDataArray(data=ts32[t], intent=intent, datatype=datatype)
+                for t in range(ts32.shape[0])
+            ])
             
             # 添加元数据
             gii_img.meta.metadata['Subject'] = subject_id
@@ -277,58 +441,106 @@ class HCPBilateralProcessor:
         except Exception as e:
             self.logger.error(f"保存GIFTI文件失败 {output_file}: {e}")
     
-    def validate_merged_data(self, merged_data, subject_id):
-        """验证合并后的数据"""
-        self.logger.info(f"验证被试 {subject_id} 的合并数据...")
+    def validate_merged_run(self, key, data):
+        """验证一个run合并后的时间序列，返回 (是否通过, 验证结果)"""
+        ts = data['timeseries']
+        
+        # NaN/Inf检查与数据范围：加载时已统计则直接使用，否则在同一次遍历中得到
+        value_stats = data.pop('value_stats', None)
+        no_nan, no_inf, lo, hi = value_stats if value_stats is not None else finite_minmax(ts)
+        
+        # 基本检查
+        checks = {
+            'shape_valid': len(ts.shape) == 2,
+            'no_nan': no_nan,
+            'no_inf': no_inf,
+            'vertices_match': ts.shape[1] == (data['n_vertices_left'] + data['n_vertices_right']),
+            'timepoints_positive': ts.shape[0] > 0,
+            'vertices_positive': ts.shape[1] > 0
+        }
         
-        validation_results = {}
-        all_valid = True
+        # 数据范围检查
+        data_range = (lo, hi)
+        checks['reasonable_range'] = -1000 < data_range[0] < data_range[1] < 1000
         
-        for key, data in merged_data.items():
-            ts = data['timeseries']
-            
-            # 基本检查
-            checks = {
-                'shape_valid': len(ts.shape) == 2,
-                'no_nan': not np.isnan(ts).any(),
-                'no_inf': not np.isinf(ts).any(),
-                'vertices_match': ts.shape[1] == (data['n_vertices_left'] + data['n_vertices_right']),
-                'timepoints_positive': ts.shape[0] > 0,
-                'vertices_positive': ts.shape[1] > 0
-            }
-            
-            # 数据范围检查
-            data_range = (float(ts.min()), float(ts.max()))
-            checks['reasonable_range'] = -1000 < data_range[0] < data_range[1] < 1000
-            
-            validation_results[key] = {
-                'checks': checks,
-                'shape': ts.shape,
-                'data_range': data_range,
-                'dtype': str(ts.dtype),
-                'memory_usage_mb': ts.nbytes / (1024**2)
-            }
-            
-            # 输出验证结果
-            self.logger.info(f"  {key}:")
-            self.logger.info(f"    形状: {ts.shape}")
-            self.logger.info(f"    数据范围: [{data_range[0]:.3f}, {data_range[1]:.3f}]")
-            self.logger.info(f"    内存使用: {ts.nbytes / (1024**2):.1f} MB")
-            
-            # 检查失败项
-            failed_checks = [check for check, passed in checks.items() if not passed]
-            if failed_checks:
-                all_valid = False
-                self.logger.warning(f"    失败的检查: {', '.join(failed_checks)}")
-            else:
-                self.logger.info(f"    ✓ 验证通过")
+        result = {
+            'checks': checks,
+            'shape': ts.shape,
+            'data_range': data_range,
+            'dtype': str(ts.dtype),
+            'memory_usage_mb': ts.nbytes / (1024**2)
+        }
+        
+        # 输出验证结果（每个run一行）
+        summary = (f"{key}: 形状 {ts.shape}, 数据范围 [{data_range[0]:.3f}, {data_range[1]:.3f}], "
+                   f"内存使用 {ts.nbytes / (1024**2):.1f} MB")
+        
+        # 检查失败项
+        failed_checks = [check for check, passed in checks.items() if not passed]
+        if failed_checks:
+            self.logger.warning(f"  {summary}, 失败的检查: {', '.join(failed_checks)}")
+        else:
+            self.logger.info(f"  {summary}, ✓ 验证通过")
         
-        # 保存验证结果
-        validation_file = self.output_dir / subject_id / "validation_results.json"
-        with open(validation_file, 'w') as f:
-            json.dump(validation_results, f, indent=2)
+        return not failed_checks, result
+    
+    def save_subject_metadata(self, subject_id, run_metadata, validation_results=None):
+        """把被试所有run的元数据和验证结果一次性写入 merge_metadata.json"""
+        subject_output_dir = self.output_dir / subject_id
+        subject_output_dir.mkdir(parents=True, exist_ok=True)
         
-        return all_valid, validation_results
+        write_json_atomic(subject_output_dir / "merge_metadata.json", {
+            'subject_id': subject_id,
+            'runs': run_metadata,
+            'validation': validation_results or {},
+        })
+    
+    def is_subject_complete(self, subject_id, merged_keys, save_formats):
+        """检查被试的输出是否已完整：merge_metadata.json记录了所有run，且各格式文件存在、非空、形状一致
+        
+        只读取元数据、.npy 文件头和Zarr数组的元数据，不加载数据。
+        """
+        subject_output_dir = self.output_dir / subject_id
+        
+        try:
+            with open(subject_output_dir / "merge_metadata.json") as f:
+                runs = json.load(f)['runs']
+        except (OSError, ValueError, KeyError):
+            return False
+        
+        for key in merged_keys:
+            if key not in runs:
+                return False
+            
+            shape = runs[key]['data_shape']
+            check_numpy = 'numpy' in save_formats
+            if 'zarr' in save_formats:
+                try:
+                    import zarr
+                except ImportError:
+                    # 未安装zarr时保存阶段改存了numpy格式
+                    check_numpy = True
+                else:
+                    try:
+                        if list(zarr.open(str(subject_output_dir / f"{key}.zarr"), mode='r').shape) != shape:
+                            return False
+                    except Exception:
+                        return False
+            
+            if check_numpy:
+                np_file = subject_output_dir / f"{key}.npy"
+                try:
+                    if list(load_merged(np_file).shape) != shape:
+                        return False
+                except (OSError, ValueError):
+                    return False
+            
+            if 'gifti' in save_formats:
+                gifti_file = subject_output_dir / f"{key}.func.gii"
+                if not gifti_file.is_file() or gifti_file.stat().st_size == 0:
+                    return False
+        
+        return True
     
     def create_summary_report(self, processed_subjects, failed_subjects):
         """创建处理摘要报告"""
@@ -368,36 +580,62 @@ class HCPBilateralProcessor:
         self.logger.info(f"摘要报告已保存到: {report_file}")
         return report_file
     
-    def process_subject(self, subject_id, save_formats=['numpy', 'gifti']):
-        """处理单个被试"""
+    def process_subject(self, subject_id, save_formats=['numpy', 'gifti'], gifti_files=None):
+        """处理单个被试，gifti_files默认取find_subjects记录的文件列表"""
+        if gifti_files is None:
+            gifti_files = self.subject_files.get(subject_id)
+        
         try:
-            # 加载数据
-            subject_data = self.load_subject_data(subject_id)
-            if not subject_data:
+            pairs = self.find_merge_pairs(subject_id, gifti_files)
+            if pairs is None:
                 return False, "无法加载数据"
             
-            # 合并半球
-            merged_data = self.merge_hemispheres(subject_data)
-            if not merged_data:
-                return False, "没有可合并的数据"
+            # 上次运行已完整输出的被试直接跳过（--force时重新处理）
+            if pairs and not self.force and self.is_subject_complete(subject_id, [key for _, _, key in pairs], save_formats):
+                self.logger.info(f"被试 {subject_id} 的输出已完整，跳过")
+                return True, "cached"
+            
+            # 先删除旧的merge_metadata.json，处理中途被杀死时不会把旧元数据和新的部分输出当作完整结果
+            (self.output_dir / subject_id / "merge_metadata.json").unlink(missing_ok=True)
+            
+            # 逐个run处理：加载合并 -> 验证 -> 保存 -> 释放，内存中最多只有一个run的数据
+            merged_info = {}
+            validation_results = {}
+            all_valid = True
+            
+            for left_file, right_file, merged_key in pairs:
+                # 保存numpy格式时直接合并到输出 .npy 的内存映射中
+                out_file = self.output_dir / subject_id / f"{merged_key}.npy" if 'numpy' in save_formats else None
+                merged = self.load_and_merge_pair(left_file, right_file, merged_key, out_file)
+                if merged is None:
+                    continue
+                
+                is_valid, validation_results[merged_key] = self.validate_merged_run(merged_key, merged)
+                if not is_valid:
+                    all_valid = False
+                    self.logger.warning(f"被试 {subject_id} 的 {merged_key} 验证发现问题，但仍继续保存")
+                
+                # 只保留元数据，时间序列随merged释放
+                merged_info[merged_key] = self.save_merged_run(merged_key, merged, subject_id, save_formats)
+                del merged
             
-            # 验证数据
-            is_valid, validation_results = self.validate_merged_data(merged_data, subject_id)
-            if not is_valid:
-                self.logger.warning(f"被试 {subject_id} 的数据验证发现问题，但仍继续保存")
+            if not merged_info:
+                return False, "没有可合并的数据"
             
-            # 保存数据
-            self.save_merged_data(merged_data, subject_id, save_formats)
+            # 元数据和验证结果在被试处理结束时统一写出一个文件
+            self.save_subject_metadata(subject_id, merged_info, validation_results)
+            if not all_valid:
+                self.logger.warning(f"被试 {subject_id} 的数据验证发现问题")
             
-            self.logger.info(f"✓ 被试 {subject_id} 处理完成")
-            return True, merged_data
+            self.logger.info(f"✓ 被试 {subject_id} 处理完成: {format_merge_summary(merged_info)}")
+            return True, merged_info
             
         except Exception as e:
             self.logger.error(f"处理被试 {subject_id} 时出错: {e}")
             return False, str(e)
     
-    def process_multiple_subjects(self, subject_list=None, save_formats=['numpy', 'gifti']):
-        """批量处理多个被试"""
+    def process_multiple_subjects(self, subject_list=None, save_formats=['numpy', 'gifti'], workers=1):
+        """批量处理多个被试，workers > 1 时各被试在独立进程中并行处理"""
         if subject_list is None:
             subject_list = self.find_subjects()
         
@@ -410,14 +648,33 @@ class HCPBilateralProcessor:
         processed_subjects = []
         failed_subjects = {}
         
-        # 使用进度条
-        for subject in tqdm(subject_list, desc="处理被试", disable=not self.verbose):
-            success, result = self.process_subject(subject, save_formats)
-            
-            if success:
-                processed_subjects.append(subject)
-            else:
-                failed_subjects[subject] = result
+        if workers > 1:
+            # 被试之间互不依赖，按被试并行
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,)) as executor:
+                futures = {
+                    executor.submit(_process_subject, subject, save_formats, self.subject_files.get(subject)): subject
+                    for subject in subject_list
+                }
+                for future in tqdm(as_completed(futures), total=len(futures), desc="处理被试", disable=not self.verbose):
+                    subject = futures[future]
+                    try:
+                        success, result = future.result()
+                    except Exception as e:
+                        success, result = False, str(e)
+                    
+                    if success:
+                        processed_subjects.append(subject)
+                    else:
+                        failed_subjects[subject] = result
+        else:
+            # 使用进度条
+            for subject in tqdm(subject_list, desc="处理被试", disable=not self.verbose):
+                success, result = self.process_subject(subject, save_formats)
+                
+                if success:
+                    processed_subjects.append(subject)
+                else:
+                    failed_subjects[subject] = result
         
         # 创建摘要报告
         self.create_summary_report(processed_subjects, failed_subjects)
@@ -447,8 +704,14 @@ def main():
   # 处理所有被试
   python hcp_merge_hemispheres.py /input/dir /output/dir --all
   
-  # 只保存numpy格式（推荐，更快）
+  # 保存为numpy格式（不需要zarr）
   python hcp_merge_hemispheres.py /input/dir /output/dir --all --format numpy
+  
+  # 4个被试并行处理
+  python hcp_merge_hemispheres.py /input/dir /output/dir --all --workers 4
+  
+  # 忽略已有输出，全部重新处理
+  python hcp_merge_hemispheres.py /input/dir /output/dir --all --force
         """
     )
     
@@ -456,8 +719,13 @@ def main():
     parser.add_argument('output_dir', help='输出目录路径')
     parser.add_argument('-s', '--subjects', nargs='+', help='要处理的被试ID列表')
     parser.add_argument('--all', action='store_true', help='处理所有找到的被试')
-    parser.add_argument('--format', choices=['numpy', 'gifti', 'both'], default='numpy', help='输出格式 (默认: numpy)')
+    parser.add_argument('--format', choices=['zarr', 'numpy', 'gifti', 'both'], default='zarr',
+                        help='输出格式 (默认: zarr，未安装zarr时改存numpy；both = numpy + gifti)')
+    parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count() // 2),
+                        help='并行处理的被试数（默认: CPU核心数的一半，受磁盘带宽限制时可调小）')
     parser.add_argument('--quiet', action='store_true', help='静默模式，减少输出')
+    parser.add_argument('--force', action='store_true',
+                        help='重新处理所有被试（默认跳过输出已完整的被试）')
     parser.add_argument('--validate-only', action='store_true', 
                         help='只验证现有的合并数据，不重新处理')
     
@@ -479,7 +747,8 @@ def main():
     processor = HCPBilateralProcessor(
         input_dir=args.input_dir,
         output_dir=args.output_dir,
-        verbose=not args.quiet
+        verbose=not args.quiet,
+        force=args.force
     )
     
     # 确定要处理的被试
@@ -508,7 +777,7 @@ def main():
                 sys.exit(1)
         else:
             # 多个被试
-            processed, failed = processor.process_multiple_subjects(subject_list, save_formats)
+            processed, failed = processor.process_multiple_subjects(subject_list, save_formats, args.workers)
             
             if failed:
                 print(f"\n注意: {len(failed)} 个被试处理失败")
@@ -5,11 +5,16 @@ HCP数据批量重采样脚本
 """
 
 import os
+import argparse
+import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
 from pathlib import Path
 import logging
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 配置日志
 logging.basicConfig(
@@ -21,6 +26,9 @@ logging.basicConfig(
     ]
 )
 
+# 中间GIFTI文件放在内存文件系统，可用HCP_TMP环境变量修改
+TEMP_DIR = os.environ.get('HCP_TMP', '/dev/shm')
+
 class HCPResampler:
     def __init__(self, base_path, subject_id, atlas_path, output_base):
         """
@@ -41,6 +49,9 @@ class HCPResampler:
         self.output_dir = self.output_base / subject_id / "fsaverage4"
         self.output_dir.mkdir(parents=True, exist_ok=True)
         
+        # 中间GIFTI文件目录，由process_all创建和清理
+        self.temp_dir = None
+        
         # 定义任务列表
         self.tasks = ['EMOTION', 'SOCIAL', 'WM', 'GAMBLING', 'LANGUAGE', 'MOTOR', 'RELATIONAL']
         self.runs = ['LR', 'RL']
@@ -80,24 +91,16 @@ class HCPResampler:
         logging.info("所有必需文件检查通过")
         return True
         
-    def separate_cifti(self, cifti_file, output_left, output_right):
-        """将CIFTI文件分离为左右半球GIFTI文件"""
-        cmd = [
+    def separate_command(self, cifti_file, output_left, output_right):
+        """构建将CIFTI文件分离为左右半球GIFTI文件的命令"""
+        return [
             "wb_command", "-cifti-separate", str(cifti_file), "COLUMN",
             "-metric", "CORTEX_LEFT", str(output_left),
             "-metric", "CORTEX_RIGHT", str(output_right)
         ]
         
-        try:
-            subprocess.run(cmd, check=True, capture_output=True, text=True)
-            logging.info(f"成功分离CIFTI文件: {cifti_file.name}")
-            return True
-        except subprocess.CalledProcessError as e:
-            logging.error(f"分离CIFTI文件失败: {e.stderr}")
-            return False
-            
-    def resample_metric(self, metric_in, hemisphere, metric_out):
-        """重采样metric文件"""
+    def resample_command(self, metric_in, hemisphere, metric_out):
+        """构建重采样metric文件的命令"""
         if hemisphere == 'L':
             current_sphere = self.sphere_files['fs_LR_32k_L']
             new_sphere = self.sphere_files['fsaverage4_L']
@@ -109,7 +112,7 @@ class HCPResampler:
             current_area = self.area_files['fs_LR_32k_R']
             new_area = self.area_files['fsaverage4_R']
             
-        cmd = [
+        return [
             "wb_command", "-metric-resample",
             str(metric_in),
             str(current_sphere),
@@ -121,14 +124,70 @@ class HCPResampler:
             str(new_area)
         ]
         
+    def cifti_script(self, cifti_file, task_output_dir, name):
+        """构建分离并重采样一个dtseries文件的bash命令，name如 EMOTION_LR_Atlas
+        
+        返回 (命令, 临时文件列表, 输出文件列表)；两个半球的重采样同时进行。
+        """
+        # 临时GIFTI文件（没有临时目录时放在任务输出目录）
+        temp_dir = self.temp_dir or task_output_dir
+        temp_left = temp_dir / f"temp_{name}.L.32k.func.gii"
+        temp_right = temp_dir / f"temp_{name}.R.32k.func.gii"
+        
+        # 输出文件
+        output_left = task_output_dir / f"tfMRI_{name}.L.3k_fsavg_L.func.gii"
+        output_right = task_output_dir / f"tfMRI_{name}.R.3k_fsavg_R.func.gii"
+        
+        separate = shlex.join(self.separate_command(cifti_file, temp_left, temp_right))
+        resample_left = shlex.join(self.resample_command(temp_left, 'L', output_left))
+        resample_right = shlex.join(self.resample_command(temp_right, 'R', output_right))
+        script = (
+            f'{separate} && {{ {resample_left} & left_pid=$!; {resample_right}; right_status=$?; '
+            f'wait $left_pid && [ $right_status -eq 0 ]; }}'
+        )
+        return script, [temp_left, temp_right], [output_left, output_right]
+        
+    def process_ciftis(self, jobs):
+        """在一次bash调用中依次处理多个dtseries文件，jobs为 [(cifti_file, task_output_dir, name), ...]
+        
+        每个文件的结果记录在退出码的对应位上，stderr分别写入各自的临时文件，返回各文件是否成功的列表。
+        """
+        scripts = []
+        temp_files = []
+        stderr_files = []
+        outputs = []
+        for i, (cifti_file, task_output_dir, name) in enumerate(jobs):
+            script, temps, outs = self.cifti_script(cifti_file, task_output_dir, name)
+            stderr_file = temps[0].parent / f"temp_{name}.stderr"
+            scripts.append(f'{{ {script}; }} 2>{shlex.quote(str(stderr_file))}; status_{i}=$?')
+            temp_files.extend(temps)
+            stderr_files.append(stderr_file)
+            outputs.append(outs)
+        failed_bits = ' | '.join(f'(( status_{i} != 0 ) << {i})' for i in range(len(jobs)))
+        scripts.append(f'exit $(( {failed_bits} ))')
+        
         try:
-            subprocess.run(cmd, check=True, capture_output=True, text=True)
-            logging.info(f"成功重采样: {metric_out.name}")
-            return True
-        except subprocess.CalledProcessError as e:
-            logging.error(f"重采样失败: {e.stderr}")
-            return False
-            
+            result = subprocess.run(['bash', '-c', '; '.join(scripts)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            # 失败时只报告该文件自己的wb_command错误输出
+            stderrs = [
+                f.read_text(errors='replace').strip() if f.exists() else ''
+                for f in stderr_files
+            ]
+        finally:
+            # 删除临时文件
+            for temp_file in temp_files + stderr_files:
+                temp_file.unlink(missing_ok=True)
+        
+        successes = []
+        for i, ((cifti_file, _, _), (output_left, output_right)) in enumerate(zip(jobs, outputs)):
+            if not result.returncode >> i & 1:
+                logging.info(f"成功重采样: {output_left.name}, {output_right.name}")
+                successes.append(True)
+            else:
+                logging.error(f"处理失败 {cifti_file.name}: {stderrs[i]}")
+                successes.append(False)
+        return successes
+        
     def process_task(self, task, run):
         """处理单个任务的数据"""
         logging.info(f"处理任务: {task}_{run}")
@@ -140,70 +199,58 @@ class HCPResampler:
         task_output_dir = self.output_dir / f"tfMRI_{task}_{run}"
         task_output_dir.mkdir(exist_ok=True)
         
-        # 处理Atlas文件（标准空间）
-        atlas_file = input_dir / f"tfMRI_{task}_{run}_Atlas.dtseries.nii"
-        if atlas_file.exists():
-            logging.info(f"处理Atlas文件: {atlas_file.name}")
-            
-            # 临时GIFTI文件
-            temp_left = task_output_dir / f"temp_{task}_{run}_Atlas.L.32k.func.gii"
-            temp_right = task_output_dir / f"temp_{task}_{run}_Atlas.R.32k.func.gii"
-            
-            # 输出文件
-            output_left = task_output_dir / f"tfMRI_{task}_{run}_Atlas.L.3k_fsavg_L.func.gii"
-            output_right = task_output_dir / f"tfMRI_{task}_{run}_Atlas.R.3k_fsavg_R.func.gii"
-            
-            # 分离CIFTI
-            if self.separate_cifti(atlas_file, temp_left, temp_right):
-                # 重采样左半球
-                self.resample_metric(temp_left, 'L', output_left)
-                # 重采样右半球
-                self.resample_metric(temp_right, 'R', output_right)
-                
-                # 删除临时文件
-                temp_left.unlink(missing_ok=True)
-                temp_right.unlink(missing_ok=True)
+        # Atlas文件（标准空间）和Atlas_MSMAll文件（MSMAll对齐）在同一次bash调用中依次处理
+        jobs = []
+        for variant in ['Atlas', 'Atlas_MSMAll']:
+            cifti_file = input_dir / f"tfMRI_{task}_{run}_{variant}.dtseries.nii"
+            if cifti_file.exists():
+                logging.info(f"处理{variant}文件: {cifti_file.name}")
+                jobs.append((cifti_file, task_output_dir, f"{task}_{run}_{variant}"))
         
-        # 处理Atlas_MSMAll文件（MSMAll对齐）
-        atlas_msmall_file = input_dir / f"tfMRI_{task}_{run}_Atlas_MSMAll.dtseries.nii"
-        if atlas_msmall_file.exists():
-            logging.info(f"处理Atlas_MSMAll文件: {atlas_msmall_file.name}")
-            
-            # 临时GIFTI文件
-            temp_left = task_output_dir / f"temp_{task}_{run}_Atlas_MSMAll.L.32k.func.gii"
-            temp_right = task_output_dir / f"temp_{task}_{run}_Atlas_MSMAll.R.32k.func.gii"
-            
-            # 输出文件
-            output_left = task_output_dir / f"tfMRI_{task}_{run}_Atlas_MSMAll.L.3k_fsavg_L.func.gii"
-            output_right = task_output_dir / f"tfMRI_{task}_{run}_Atlas_MSMAll.R.3k_fsavg_R.func.gii"
-            
-            # 分离CIFTI
-            if self.separate_cifti(atlas_msmall_file, temp_left, temp_right):
-                # 重采样左半球
-                self.resample_metric(temp_left, 'L', output_left)
-                # 重采样右半球
-                self.resample_metric(temp_right, 'R', output_right)
-                
-                # 删除临时文件
-                temp_left.unlink(missing_ok=True)
-                temp_right.unlink(missing_ok=True)
+        if jobs:
+            self.process_ciftis(jobs)
                 
-    def process_all(self):
-        """处理所有任务的数据"""
+    def create_temp_dir(self):
+        """在TEMP_DIR（默认/dev/shm）下创建临时目录，不可用时使用系统默认临时目录"""
+        for temp_root in [TEMP_DIR, None]:
+            if temp_root is not None and not os.path.isdir(temp_root):
+                continue
+            try:
+                temp_dir = Path(tempfile.mkdtemp(prefix=f'hcp_resample_{self.subject_id}_', dir=temp_root))
+            except OSError as e:
+                logging.warning(f"无法在 {temp_root} 创建临时目录: {e}")
+                continue
+            logging.info(f"中间文件目录: {temp_dir}")
+            return temp_dir
+        return None
+        
+    def process_all(self, workers=1):
+        """处理所有任务的数据，workers个(任务, run)同时进行"""
         if not self.check_files():
             logging.error("文件检查失败，退出处理")
             return
             
-        logging.info(f"开始处理被试 {self.subject_id} 的数据")
+        logging.info(f"开始处理被试 {self.subject_id} 的数据（并行任务数: {workers}）")
         
-        total_tasks = len(self.tasks) * len(self.runs)
+        pairs = [(task, run) for task in self.tasks for run in self.runs]
+        total_tasks = len(pairs)
         completed = 0
         
-        for task in self.tasks:
-            for run in self.runs:
-                self.process_task(task, run)
-                completed += 1
-                logging.info(f"进度: {completed}/{total_tasks} ({completed/total_tasks*100:.1f}%)")
+        # 分离得到的32k GIFTI只被重采样读取一次，不必写到硬盘
+        self.temp_dir = self.create_temp_dir()
+        
+        try:
+            # 主要时间花在wb_command子进程中，线程只负责启动和等待
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self.process_task, task, run) for task, run in pairs]
+                for future in as_completed(futures):
+                    future.result()
+                    completed += 1
+                    logging.info(f"进度: {completed}/{total_tasks} ({completed/total_tasks*100:.1f}%)")
+        finally:
+            if self.temp_dir is not None:
+                shutil.rmtree(self.temp_dir, ignore_errors=True)
+                self.temp_dir = None
                 
         logging.info("所有任务处理完成！")
         
@@ -229,6 +276,11 @@ class HCPResampler:
 
 def main():
     """主函数"""
+    parser = argparse.ArgumentParser(description='HCP数据重采样到fsaverage4')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help='同时处理的(任务, run)数（默认: CPU核心数的一半）')
+    args = parser.parse_args()
+    
     # 配置参数（根据您的实际路径修改）
     '''
     BASE_PATH = "F:/preprocessed" # HCP数据基础路径
@@ -246,7 +298,7 @@ def main():
     OUTPUT_BASE="/media/yxl/yxl_4TB/hcp_resample/output"
     # 检查wb_command是否可用
     try:
-        subprocess.run(["wb_command", "-version"], capture_output=True, check=True)
+        subprocess.run(["wb_command", "-version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
     except (subprocess.CalledProcessError, FileNotFoundError):
         logging.error("wb_command未找到！请确保Connectome Workbench已安装并在PATH中")
         sys.exit(1)
@@ -255,7 +307,7 @@ def main():
     resampler = HCPResampler(BASE_PATH, SUBJECT_ID, ATLAS_PATH, OUTPUT_BASE)
     
     # 处理所有数据
-    resampler.process_all()
+    resampler.process_all(args.workers)
     
     # 创建摘要
     resampler.create_summary()
@@ -8,18 +8,192 @@ HCP重采样数据分析工具
 """
 
 import os
+import re
 import sys
 import numpy as np
 import nibabel as nib
-import pandas as pd
 from pathlib import Path
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-from scipy import stats
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import argparse
 
+# matplotlib/seaborn/pandas、sklearn和scipy只在用到它们的方法中导入，
+# 不画图或不做PCA时不必承担这些导入的时间和内存
+
+# 文件名解析：session、相位编码方向和半球，例如
+# rfMRI_REST1_LR_Atlas_hp2000_clean.R.3k_fsavg_R.func.gii -> REST1_LR_R
+FILENAME_RE = re.compile(r'REST(?P<session>[12])_(?P<phase>LR|RL)_.*?\.(?P<hemi>[LR])\.')
+
+# 同时读取的GIFTI文件数（读取和解压时释放GIL）
+LOAD_THREADS = 4
+
+# numba编译的函数 {名称: 函数}，首次使用时创建；numba不可用时为False
+_NUMBA_KERNELS = None
+
+
+def _get_numba_kernel(name):
+    """返回numba编译的 seed_corr 或 column_stats 函数，numba不可用时返回None"""
+    global _NUMBA_KERNELS
+    if _NUMBA_KERNELS is None:
+        try:
+            from numba import njit, prange
+        except ImportError:
+            _NUMBA_KERNELS = False
+        else:
+            @njit(parallel=True, cache=True)
+            def seed_corr_kernel(xc, sxx, Y):
+                # xc为已去均值的种子时间序列，sxx为其平方和；按64个顶点一块并行，
+                # 块内逐行读取（连续内存），先求均值再累加去均值后的乘积和平方和（float64）
+                n, V = Y.shape
+                r = np.empty(V)
+                for b in prange((V + 63) // 64):
+                    j0 = b * 64
+                    j1 = min(V, j0 + 64)
+                    mean = np.zeros(j1 - j0)
+                    for t in range(n):
+                        for j in range(j0, j1):
+                            mean[j - j0] += Y[t, j]
+                    mean /= n
+                    sxy = np.zeros(j1 - j0)
+                    syy = np.zeros(j1 - j0)
+                    for t in range(n):
+                        for j in range(j0, j1):
+                            y = Y[t, j] - mean[j - j0]
+                            sxy[j - j0] += xc[t] * y
+                            syy[j - j0] += y * y
+                    r[j0:j1] = sxy / np.sqrt(sxx * syy)
+                return r
+            
+            @njit(parallel=True, cache=True)
+            def column_stats_kernel(Y):
+                # 每个顶点的均值、标准差（总体）、最小值、最大值；与seed_corr_kernel相同的分块方式，
+                # 用Welford算法一遍得到均值和方差（float64累加，数值稳定）
+                n, V = Y.shape
+                mean = np.empty(V)
+                std = np.empty(V)
+                mn = np.empty(V)
+                mx = np.empty(V)
+                for b in prange((V + 63) // 64):
+                    j0 = b * 64
+                    j1 = min(V, j0 + 64)
+                    m = np.zeros(j1 - j0)
+                    m2 = np.zeros(j1 - j0)
+                    lo = np.full(j1 - j0, np.inf)
+                    hi = np.full(j1 - j0, -np.inf)
+                    for t in range(n):
+                        for j in range(j0, j1):
+                            y = Y[t, j]
+                            d = y - m[j - j0]
+                            m[j - j0] += d / (t + 1)
+                            m2[j - j0] += d * (y - m[j - j0])
+                            lo[j - j0] = min(lo[j - j0], y)
+                            hi[j - j0] = max(hi[j - j0], y)
+                    mean[j0:j1] = m
+                    std[j0:j1] = np.sqrt(m2 / n)
+                    mn[j0:j1] = lo
+                    mx[j0:j1] = hi
+                return mean, std, mn, mx
+            
+            _NUMBA_KERNELS = {
+                'seed_corr': seed_corr_kernel,
+                'column_stats': column_stats_kernel,
+            }
+    return _NUMBA_KERNELS[name] if _NUMBA_KERNELS else None
+
+
+def column_stats(timeseries):
+    """一次得到每个顶点的时间均值、时间标准差、最小值和最大值，返回 (mean, std, min, max)
+    
+    有numba时在并行编译的核函数中一遍完成，否则用numpy逐项计算。
+    """
+    kernel = _get_numba_kernel('column_stats')
+    if kernel is not None:
+        return kernel(timeseries)
+    return timeseries.mean(axis=0), timeseries.std(axis=0), timeseries.min(axis=0), timeseries.max(axis=0)
+
+
+def seed_correlation(seed, timeseries):
+    """种子时间序列 (时间点,) 与每个顶点时间序列 (时间点, 顶点) 的皮尔逊相关，返回 (顶点,)
+    
+    有numba时用并行编译的核函数（float64累加），否则用矩阵-向量乘积计算；常数顶点的结果为NaN。
+    """
+    xc = np.asarray(seed, dtype=np.float64)
+    xc = xc - xc.mean()
+    sxx = np.dot(xc, xc)
+    
+    kernel = _get_numba_kernel('seed_corr')
+    if kernel is not None:
+        return kernel(xc, sxx, timeseries)
+    
+    Yc = timeseries - timeseries.mean(axis=0)
+    return (xc.astype(Yc.dtype) @ Yc) / np.sqrt(sxx * np.einsum('ij,ij->j', Yc, Yc))
+
+
+# 工作进程内的分析器，由_init_worker在每个进程启动时设置一次
+_WORKER_ANALYZER = None
+
+
+# 工作进程内对BLAS线程池的限制，保留引用使限制在进程内一直有效
+_WORKER_THREAD_LIMITS = None
+
+
+def _init_worker(analyzer, threads=None):
+    """进程池initializer：每个工作进程只接收一次分析器
+    
+    threads为每个进程可用的线程数：numba并行函数和BLAS（syrk、PCA）默认各自按全部核心开线程，
+    多个工作进程同时运行时线程数成倍超出核心数，因此限制为各进程平分核心。
+    numba或threadpoolctl不可用时跳过相应的限制。
+    """
+    global _WORKER_ANALYZER, _WORKER_THREAD_LIMITS
+    _WORKER_ANALYZER = analyzer
+    
+    if threads is None:
+        return
+    try:
+        import numba
+        numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+    except ImportError:
+        pass
+    try:
+        from threadpoolctl import threadpool_limits
+        _WORKER_THREAD_LIMITS = threadpool_limits(limits=threads)
+    except ImportError:
+        pass
+
+
+def _analyze_subject(subject_id, export_csv, create_plots):
+    """进程池任务入口：分析单个被试，只返回是否成功，不把数据和结果传回主进程"""
+    return _WORKER_ANALYZER.analyze_subject(subject_id, export_csv=export_csv, create_plots=create_plots) is not None
+
+
+def correlation_matrix(timeseries):
+    """计算 (时间点, 顶点) 时间序列的顶点间皮尔逊相关矩阵，结果与np.corrcoef(timeseries.T)一致
+    
+    每个顶点去均值并缩放为单位范数后，相关矩阵即 X.T @ X；用BLAS的syrk只计算上三角
+    （float32输入用ssyrk，float64用dsyrk），再镜像到下三角。均值和标准差由column_stats一遍得到。
+    """
+    mean, std = column_stats(timeseries)[:2]
+    X = timeseries - mean.astype(timeseries.dtype)
+    # 单位范数 = 总体标准差 * sqrt(时间点数)
+    X /= (std * np.sqrt(timeseries.shape[0])).astype(timeseries.dtype)
+    
+    # C顺序的 (T, V) 数组就是Fortran顺序的 (V, T)，传X.T不产生复制
+    from scipy.linalg import blas
+    syrk = blas.get_blas_funcs('syrk', (X,))
+    upper = syrk(1.0, X.T, trans=0, lower=0)
+    
+    conn_matrix = np.triu(upper)
+    conn_matrix += np.triu(upper, 1).T
+    np.clip(conn_matrix, -1, 1, out=conn_matrix)
+    return conn_matrix
+
+
+def pearson_correlation(a, b):
+    """两个一维向量的皮尔逊相关系数，等价于np.corrcoef(a, b)[0, 1]但不构造2x2矩阵"""
+    a = a - a.mean()
+    b = b - b.mean()
+    return float(np.dot(a, b) / np.sqrt(np.dot(a, a) * np.dot(b, b)))
+
+
 class HCPDataAnalyzer:
     """HCP重采样数据分析类"""
     
@@ -35,54 +209,44 @@ class HCPDataAnalyzer:
         if not subject_dir.exists():
             raise FileNotFoundError(f"被试目录不存在: {subject_dir}")
         
-        data = {}
+        files = {}
         
         # 查找所有func.gii文件
         for func_file in subject_dir.glob("*.func.gii"):
             # 解析文件名
-            filename = func_file.name
-            parts = filename.replace('.func.gii', '').split('.')
-            
-            # 提取信息
-            if 'REST1' in filename:
-                session = 'REST1'
-            elif 'REST2' in filename:
-                session = 'REST2'
-            else:
-                continue
-                
-            if '_LR_' in filename:
-                phase = 'LR'
-            elif '_RL_' in filename:
-                phase = 'RL'
-            else:
-                continue
-                
-            if '.L.' in filename:
-                hemisphere = 'L'
-            elif '.R.' in filename:
-                hemisphere = 'R'
-            else:
+            match = FILENAME_RE.search(func_file.name)
+            if match is None:
                 continue
             
-            # 加载数据
-            try:
-                gii = nib.load(str(func_file))
-                timeseries = gii.darrays[0].data.T  # 转置为 (time, vertices)
-                
-                key = f"{session}_{phase}_{hemisphere}"
-                data[key] = {
-                    'timeseries': timeseries,
-                    'filename': filename,
-                    'n_timepoints': timeseries.shape[0],
-                    'n_vertices': timeseries.shape[1]
-                }
-                
-            except Exception as e:
-                print(f"警告: 无法加载文件 {func_file}: {e}")
+            files[f"REST{match['session']}_{match['phase']}_{match['hemi']}"] = func_file
+        
+        # 多个文件同时读取
+        with ThreadPoolExecutor(max_workers=LOAD_THREADS) as executor:
+            loaded = executor.map(self.load_gifti_file, files.values())
+            data = {key: item for key, item in zip(files, loaded) if item is not None}
                 
         return data
     
+    def load_gifti_file(self, func_file):
+        """加载一个func.gii文件，失败时返回None"""
+        try:
+            gii = nib.load(str(func_file))
+            # 转置为 (time, vertices) 并一次性复制为连续的float32，
+            # 之后按axis=0/1的归约都在连续内存上进行，不再隐式复制转置视图；
+            # 总是复制（即使转置后恰好连续），时间序列不引用GiftiImage的数据，gii可随函数返回释放
+            timeseries = np.array(gii.darrays[0].data.T, dtype=np.float32, order='C', copy=True)
+            
+            return {
+                'timeseries': timeseries,
+                'filename': func_file.name,
+                'n_timepoints': timeseries.shape[0],
+                'n_vertices': timeseries.shape[1]
+            }
+            
+        except Exception as e:
+            print(f"警告: 无法加载文件 {func_file}: {e}")
+            return None
+    
     def compute_basic_stats(self, subject_data):
         """计算基本统计信息"""
         stats_summary = {}
@@ -90,15 +254,21 @@ class HCPDataAnalyzer:
         for key, data in subject_data.items():
             timeseries = data['timeseries']
             
+            # 全局统计量由每个顶点的统计量得到，不必再遍历整个数组
+            temporal_mean, temporal_std, vertex_min, vertex_max = column_stats(timeseries)
+            global_mean = temporal_mean.mean()
+            # 总方差 = 顶点内方差的均值 + 顶点均值相对全局均值的方差
+            global_std = np.sqrt(np.mean(temporal_std ** 2 + (temporal_mean - global_mean) ** 2))
+            
             stats_summary[key] = {
-                'mean': np.mean(timeseries),
-                'std': np.std(timeseries),
-                'min': np.min(timeseries),
-                'max': np.max(timeseries),
+                'mean': global_mean,
+                'std': global_std,
+                'min': vertex_min.min(),
+                'max': vertex_max.max(),
                 'n_timepoints': timeseries.shape[0],
                 'n_vertices': timeseries.shape[1],
-                'temporal_mean': np.mean(timeseries, axis=0),  # 每个顶点的时间平均
-                'temporal_std': np.std(timeseries, axis=0),    # 每个顶点的时间标准差
+                'temporal_mean': temporal_mean,  # 每个顶点的时间平均
+                'temporal_std': temporal_std,    # 每个顶点的时间标准差
             }
             
         return stats_summary
@@ -122,13 +292,13 @@ class HCPDataAnalyzer:
                     difference = lr_mean - rl_mean
                     
                     # 计算相关性
-                    correlation = np.corrcoef(lr_mean, rl_mean)[0, 1]
+                    correlation = pearson_correlation(lr_mean, rl_mean)
                     
                     comparisons[f"{session}_{hemisphere}"] = {
                         'difference': difference,
                         'correlation': correlation,
                         'mean_abs_diff': np.mean(np.abs(difference)),
-                        'rmse': np.sqrt(np.mean(difference**2))
+                        'rmse': np.sqrt(np.dot(difference, difference) / difference.size)
                     }
         
         # 保存比较结果
@@ -139,7 +309,7 @@ class HCPDataAnalyzer:
         """计算连接矩阵"""
         if method == 'correlation':
             # 使用皮尔逊相关
-            conn_matrix = np.corrcoef(timeseries.T)
+            conn_matrix = correlation_matrix(timeseries)
         elif method == 'partial_correlation':
             # 偏相关（需要scikit-learn）
             from sklearn.covariance import GraphicalLassoCV
@@ -164,35 +334,76 @@ class HCPDataAnalyzer:
             
         return roi_data
     
-    def perform_pca_analysis(self, subject_data, n_components=10):
-        """执行主成分分析"""
+    def compute_seed_connectivity(self, subject_data, roi_indices):
+        """以ROI平均时间序列为种子，计算每个条件下种子与所有顶点的相关图"""
+        roi_data = self.extract_roi_timeseries(subject_data, roi_indices)
+        
+        return {
+            key: seed_correlation(roi_data[key], data['timeseries'])
+            for key, data in subject_data.items()
+        }
+    
+    def perform_pca_analysis(self, subject_data, n_components=10, keep_components=False):
+        """执行主成分分析
+        
+        默认只返回各成分的解释方差比（累计值可由np.cumsum得到）；keep_components为True时
+        同时返回成分得分 (时间点, 成分) 和载荷 (成分, 顶点)。
+        """
+        from sklearn.decomposition import PCA
+        
         pca_results = {}
         
         for key, data in subject_data.items():
             timeseries = data['timeseries']
             
-            # 标准化数据
-            scaler = StandardScaler()
-            timeseries_scaled = scaler.fit_transform(timeseries)
+            # 标准化数据（与StandardScaler相同，标准差为0的顶点不缩放），只产生一份副本，原数据不变
+            mean, std = column_stats(timeseries)[:2]
+            timeseries_scaled = timeseries - mean.astype(timeseries.dtype)
+            scale = std.astype(timeseries.dtype)
+            scale[scale == 0] = 1
+            timeseries_scaled /= scale
             
-            # PCA
-            pca = PCA(n_components=n_components)
-            components = pca.fit_transform(timeseries_scaled)
+            # PCA：只需前n_components个成分，随机化SVD远少于完整SVD的计算量；
+            # timeseries_scaled是本函数自己的副本，copy=False让PCA直接在其上去均值，不再复制
+            pca = PCA(n_components=n_components, svd_solver='randomized', random_state=0, copy=False)
+            # 不需要成分得分时只拟合，不计算投影
+            if keep_components:
+                components = pca.fit_transform(timeseries_scaled)
+            else:
+                pca.fit(timeseries_scaled)
+            # 下一个条件分配副本前先释放，峰值内存只有一个条件的副本
+            del timeseries_scaled
             
             pca_results[key] = {
-                'components': components,
-                'explained_variance_ratio': pca.explained_variance_ratio_,
-                'cumulative_variance': np.cumsum(pca.explained_variance_ratio_),
-                'loadings': pca.components_
+                'explained_variance_ratio': pca.explained_variance_ratio_
             }
+            if keep_components:
+                pca_results[key]['components'] = components
+                pca_results[key]['loadings'] = pca.components_
             
         return pca_results
     
     def create_visualization(self, subject_data, subject_id):
         """创建可视化图表"""
+        import matplotlib
+        matplotlib.use('Agg')  # 不需要显示窗口，在多个工作进程中绘图也安全
+        import matplotlib.pyplot as plt
+        import pandas as pd
+        import seaborn as sns
+        
         fig, axes = plt.subplots(2, 3, figsize=(18, 12))
         fig.suptitle(f'被试 {subject_id} 数据分析', fontsize=16)
         
+        # 多个面板共用的归约只计算一次：全脑信号（每个时间点的空间平均）用于面板3和5，
+        # 顶点的时间平均用于面板4和6，按需计算并缓存
+        global_signals = {key: np.mean(data['timeseries'], axis=1) for key, data in subject_data.items()}
+        temporal_means = {}
+        
+        def temporal_mean(key):
+            if key not in temporal_means:
+                temporal_means[key] = np.mean(subject_data[key]['timeseries'], axis=0)
+            return temporal_means[key]
+        
         # 1. 时间序列示例
         ax = axes[0, 0]
         for i, (key, data) in enumerate(subject_data.items()):
@@ -207,29 +418,24 @@ class HCPDataAnalyzer:
         
         # 2. 数据分布
         ax = axes[0, 1]
-        all_values = []
-        labels = []
-        for key, data in subject_data.items():
-            sample_values = data['timeseries'].flatten()[::1000]  # 采样
-            all_values.extend(sample_values)
-            labels.extend([key] * len(sample_values))
-        
-        df = pd.DataFrame({'value': all_values, 'condition': labels})
+        # 直接用数组构建DataFrame，避免把每个采样值转为Python对象
+        keys = list(subject_data.keys())
+        # 每1000个值采样1个；时间序列是连续数组，ravel返回视图，不复制整个数组
+        samples = [data['timeseries'].ravel()[::1000] for data in subject_data.values()]
+        df = pd.DataFrame({
+            'value': np.concatenate(samples),
+            'condition': np.repeat(keys, [len(sample) for sample in samples])
+        })
         sns.boxplot(data=df, x='condition', y='value', ax=ax)
         ax.set_title('数据分布')
         ax.tick_params(axis='x', rotation=45)
         
         # 3. 时间维度统计
         ax = axes[0, 2]
-        temporal_stats = []
-        conditions = []
-        for key, data in subject_data.items():
-            # 计算每个时间点的全脑平均
-            global_signal = np.mean(data['timeseries'], axis=1)
-            temporal_stats.extend(global_signal)
-            conditions.extend([key] * len(global_signal))
-        
-        df_temporal = pd.DataFrame({'global_signal': temporal_stats, 'condition': conditions})
+        df_temporal = pd.DataFrame({
+            'global_signal': np.concatenate(list(global_signals.values())),
+            'condition': np.repeat(keys, [len(signal) for signal in global_signals.values()])
+        })
         sns.violinplot(data=df_temporal, x='condition', y='global_signal', ax=ax)
         ax.set_title('全脑信号分布')
         ax.tick_params(axis='x', rotation=45)
@@ -239,8 +445,8 @@ class HCPDataAnalyzer:
         if len(subject_data) >= 2:
             keys = list(subject_data.keys())
             if 'REST1_LR_L' in keys and 'REST1_RL_L' in keys:
-                lr_mean = np.mean(subject_data['REST1_LR_L']['timeseries'], axis=0)
-                rl_mean = np.mean(subject_data['REST1_RL_L']['timeseries'], axis=0)
+                lr_mean = temporal_mean('REST1_LR_L')
+                rl_mean = temporal_mean('REST1_RL_L')
                 ax.scatter(lr_mean[::10], rl_mean[::10], alpha=0.5)
                 ax.plot([lr_mean.min(), lr_mean.max()], [lr_mean.min(), lr_mean.max()], 'r--')
                 ax.set_xlabel('LR 时间平均')
@@ -249,11 +455,11 @@ class HCPDataAnalyzer:
         
         # 5. 功率谱
         ax = axes[1, 1]
-        for i, (key, data) in enumerate(subject_data.items()):
+        for i, key in enumerate(subject_data):
             if i < 2:  # 只显示前2个
                 # 计算功率谱
                 from scipy import signal
-                global_signal = np.mean(data['timeseries'], axis=1)
+                global_signal = global_signals[key]
                 freqs, psd = signal.welch(global_signal, fs=1/0.72, nperseg=min(256, len(global_signal)//4))
                 ax.loglog(freqs, psd, label=key, alpha=0.7)
         ax.set_xlabel('频率 (Hz)')
@@ -265,7 +471,7 @@ class HCPDataAnalyzer:
         ax = axes[1, 2]
         if subject_data:
             first_key = list(subject_data.keys())[0]
-            spatial_pattern = np.mean(subject_data[first_key]['timeseries'], axis=0)
+            spatial_pattern = temporal_mean(first_key)
             ax.hist(spatial_pattern, bins=50, alpha=0.7)
             ax.set_xlabel('时间平均信号')
             ax.set_ylabel('顶点数')
@@ -300,9 +506,10 @@ class HCPDataAnalyzer:
             # 导出时间序列（采样以减少文件大小）
             timeseries = data['timeseries'][::10, ::10]  # 每10个采样1个
             
-            df = pd.DataFrame(timeseries)
+            # 直接由numpy写出，表头与DataFrame.to_csv相同（列号）；%.9g可无损还原float32
             output_file = self.output_dir / f"{subject_id}_{key}_sampled.csv"
-            df.to_csv(output_file, index=False)
+            header = ','.join(str(i) for i in range(timeseries.shape[1]))
+            np.savetxt(output_file, timeseries, delimiter=',', fmt='%.9g', header=header, comments='')
             
             print(f"CSV文件已保存: {output_file}")
     
@@ -360,6 +567,8 @@ def main():
                         help='导出CSV文件')
     parser.add_argument('--no-plots', action='store_true',
                         help='不生成图表')
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 1) // 2),
+                        help='并行分析的被试数（默认: CPU核心数的一半）')
     
     args = parser.parse_args()
     
@@ -370,25 +579,37 @@ def main():
     if args.subjects:
         subjects = args.subjects
     else:
-        # 自动查找所有被试
-        data_path = Path(args.data_dir)
-        subjects = [d.name for d in data_path.iterdir() if d.is_dir()]
+        # 自动查找所有被试（scandir的目录项自带类型信息，不必逐个stat）
+        with os.scandir(args.data_dir) as it:
+            subjects = [entry.name for entry in it if entry.is_dir()]
     
     print(f"将分析 {len(subjects)} 个被试")
     
     # 分析每个被试
-    results = {}
-    for subject in subjects:
-        result = analyzer.analyze_subject(
-            subject, 
-            export_csv=args.csv,
-            create_plots=not args.no_plots
-        )
-        if result:
-            results[subject] = result
+    if args.workers > 1:
+        # 被试之间互不依赖，按被试并行；结果已保存到输出目录，只统计成功的被试。
+        # 各进程平分CPU核心，避免进程内的numba/BLAS线程池再各自占满全部核心
+        threads = max(1, (os.cpu_count() or 1) // args.workers)
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(analyzer, threads)) as executor:
+            successes = executor.map(
+                _analyze_subject, subjects,
+                [args.csv] * len(subjects), [not args.no_plots] * len(subjects)
+            )
+            succeeded = [subject for subject, success in zip(subjects, successes) if success]
+    else:
+        results = {}
+        for subject in subjects:
+            result = analyzer.analyze_subject(
+                subject, 
+                export_csv=args.csv,
+                create_plots=not args.no_plots
+            )
+            if result:
+                results[subject] = result
+        succeeded = list(results)
     
     print(f"\n分析完成！结果保存在: {args.output}")
-    print(f"成功分析 {len(results)} 个被试")
+    print(f"成功分析 {len(succeeded)} 个被试")
 
 
 if __name__ == '__main__':
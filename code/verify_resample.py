@@ -6,17 +6,29 @@
 
 import os
 from pathlib import Path
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import nibabel as nib
+
+# 同时检查的文件数，文件之间互不依赖
+CHECK_THREADS = 32
 
 def check_gifti_info(gifti_file):
-    """获取GIFTI文件信息"""
+    """用nibabel读取GIFTI文件的顶点数（不再为每个文件启动wb_command），读取失败时返回None"""
     try:
-        cmd = ["wb_command", "-file-information", str(gifti_file)]
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        return result.stdout
-    except subprocess.CalledProcessError:
+        gii = nib.load(str(gifti_file), mmap=True)
+        dims = gii.darrays[0].dims
+        return dims[0] if dims[0] != 1 or len(dims) == 1 else dims[1]
+    except Exception:
         return None
 
+def check_file(filepath):
+    """检查一个输出文件，返回 (是否存在, 文件大小MB, 顶点数)"""
+    try:
+        size_mb = filepath.stat().st_size / (1024 * 1024)
+    except FileNotFoundError:
+        return False, None, None
+    return True, size_mb, check_gifti_info(filepath)
+
 def verify_resampled_data(output_base, subject_id):
     """验证重采样的数据"""
     
@@ -33,10 +45,11 @@ def verify_resampled_data(output_base, subject_id):
     tasks = ['EMOTION', 'SOCIAL', 'WM', 'GAMBLING', 'LANGUAGE', 'MOTOR', 'RELATIONAL']
     runs = ['LR', 'RL']
     
-    total_files = 0
     missing_files = []
     verified_files = []
     
+    # 先列出所有预期文件，再并行检查
+    expected_files = []
     for task in tasks:
         for run in runs:
             task_dir = base_dir / f"tfMRI_{task}_{run}"
@@ -49,23 +62,24 @@ def verify_resampled_data(output_base, subject_id):
                     else:
                         filename = f"tfMRI_{task}_{run}_{atlas_type}.R.3k_fsavg_R.func.gii"
                     
-                    filepath = task_dir / filename
-                    total_files += 1
-                    
-                    if filepath.exists():
-                        # 检查文件大小
-                        size_mb = filepath.stat().st_size / (1024 * 1024)
-                        
-                        # 获取文件信息
-                        info = check_gifti_info(filepath)
-                        if info and "Number of Vertices: 2562" in info:
-                            vertices_check = "✓ (2562 vertices)"
-                        else:
-                            vertices_check = "✗ (顶点数不正确)"
-                        
-                        verified_files.append(f"{filename} ({size_mb:.1f} MB) {vertices_check}")
-                    else:
-                        missing_files.append(str(filepath.relative_to(base_dir)))
+                    expected_files.append(task_dir / filename)
+    
+    total_files = len(expected_files)
+    
+    # map按输入顺序返回结果，输出顺序与逐个检查时相同
+    with ThreadPoolExecutor(max_workers=CHECK_THREADS) as executor:
+        results = executor.map(check_file, expected_files)
+        
+        for filepath, (exists, size_mb, n_vertices) in zip(expected_files, results):
+            if exists:
+                if n_vertices == 2562:
+                    vertices_check = "✓ (2562 vertices)"
+                else:
+                    vertices_check = "✗ (顶点数不正确)"
+                
+                verified_files.append(f"{filepath.name} ({size_mb:.1f} MB) {vertices_check}")
+            else:
+                missing_files.append(str(filepath.relative_to(base_dir)))
     
     # 打印结果
     print(f"\n检查结果:")